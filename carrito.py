@@ -1,14 +1,34 @@
 # carrito.py
 from kivy.metrics import dp
 from kivy.app import App
+from kivy.clock import Clock
+from kivy.lang import Builder
 from kivy.uix.screenmanager import Screen, NoTransition
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.textinput import TextInput
 from kivy.uix.label import Label
 from kivy.uix.button import Button
-from kivy.uix.scrollview import ScrollView
-from kivy.uix.gridlayout import GridLayout
-import sqlite3, os, json, time, re, random
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.properties import NumericProperty, ObjectProperty, StringProperty
+import sqlite3, json, time, re
+from bisect import bisect_left
+from functools import lru_cache
+
+from db_utils import DB_PATH, fmt_clp, fts_query, like_escape, open_con
+from tomar_pedido import invalidate_draft
+
+# orjson (opcional) serializa el borrador bastante más rápido; si no está, json estándar
+try:
+    import orjson as _orjson  # type: ignore[import-not-found]
+except ImportError:
+    _orjson = None
+
+def _json_dumps(obj):
+    return _orjson.dumps(obj).decode() if _orjson else json.dumps(obj)
+
+def _json_loads(s):
+    return _orjson.loads(s) if _orjson else json.loads(s)
 
 print("[CART] Cargando módulo desde:", __file__)
 
@@ -16,14 +36,37 @@ print("[CART] Cargando módulo desde:", __file__)
 ROW_MIN_H = dp(48)
 BTN_W     = dp(44)
 IVA       = 0.19
+ROW_H     = ROW_MIN_H + dp(12)   # alto fijo de fila en las RecycleView
+DEBOUNCE_S = 0.25   # espera tras la última tecla antes de consultar
+PERSIST_DEBOUNCE_S = 0.5   # ráfagas de +/–/X => un solo UPSERT del borrador
+# Las sugerencias buscan primero "empieza con" ('term%', resoluble por índice).
+# False => si eso trae menos de SUGGEST_MIN_ROWS se completa con "contiene" (FTS o '%term%');
+# True  => solo "empieza con"
+SUGGEST_STARTS_WITH = False
+SUGGEST_MIN_ROWS    = 10
+SUGGEST_LIMIT       = 50
 
 # ---- BD ----
-def _db_path():
-    base = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(base, "bd_sqlite", "todoferre.db")
+_EXTERNAL_INDEXES = [
+    ("pricelist", "CREATE INDEX IF NOT EXISTS ix_pricelist_region_sku ON pricelist(region, sku)"),
+    ("productos", "CREATE INDEX IF NOT EXISTS ix_productos_sku ON productos(sku)"),
+    ("clientes",  "CREATE INDEX IF NOT EXISTS ix_clientes_nombre_fantasia ON clientes(nombre_fantasia)"),
+    ("clientes",  "CREATE INDEX IF NOT EXISTS ix_clientes_nombre_completo ON clientes(nombre_completo)"),
+    ("clientes",  "CREATE INDEX IF NOT EXISTS ix_clientes_nif ON clientes(numero_identificacion_fiscal)"),
+    # búsquedas "empieza con" sin distinguir mayúsculas (historial._reload)
+    ("clientes",  "CREATE INDEX IF NOT EXISTS ix_clientes_nombre_fantasia_low ON clientes(lower(nombre_fantasia))"),
+    ("clientes",  "CREATE INDEX IF NOT EXISTS ix_clientes_nombre_completo_low ON clientes(lower(nombre_completo))"),
+    ("clientes",  "CREATE INDEX IF NOT EXISTS ix_clientes_nif_low ON clientes(lower(numero_identificacion_fiscal))"),
+]
+
+_TABLES_READY = False
 
 def _ensure_tables():
-    con = sqlite3.connect(_db_path()); cur = con.cursor()
+    """Crea tablas/índices una sola vez por proceso (las llamadas siguientes no hacen nada)."""
+    global _TABLES_READY
+    if _TABLES_READY:
+        return
+    con = sqlite3.connect(DB_PATH); cur = con.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS order_drafts (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -87,34 +130,185 @@ def _ensure_tables():
       total INTEGER NOT NULL
     )
     """)
+    # índices para los filtros reales de _suggest / historial._reload / lookup por sku
+    # cubre las 4 columnas que lista historial => recorrido solo-índice (reemplaza ix_orders_user_id)
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_orders_user_id_cover
+                   ON orders(user, id DESC, order_no, cliente_display, total, created_at)""")
+    cur.execute("DROP INDEX IF EXISTS ix_orders_user_id")
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    existing = {r[0] for r in cur.fetchall()}
+    for table, ddl in _EXTERNAL_INDEXES:
+        if table in existing:   # tablas que no crea esta app (vienen de la sincronización)
+            cur.execute(ddl)
+    _ensure_fts(cur, existing)
     con.commit(); con.close()
+    _TABLES_READY = True
+
+# espejos FTS5 (contenido externo) para búsquedas "contiene" sin recorrer la tabla
+_FTS_TABLES = [
+    ("pricelist", "pricelist_fts", ("sku", "reglas_de_lista_de_precios_producto")),
+]
+
+def _ensure_fts(cur, existing):
+    for table, fts, cols in _FTS_TABLES:
+        if table not in existing or fts in existing:
+            continue
+        cur.execute(f"PRAGMA table_info({table})")
+        if not set(cols) <= {r[1] for r in cur.fetchall()}:
+            continue
+        collist  = ", ".join(cols)
+        new_vals = ", ".join(f"new.{c}" for c in cols)
+        old_vals = ", ".join(f"old.{c}" for c in cols)
+        try:
+            cur.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({collist}, content='{table}', content_rowid='rowid')")
+        except sqlite3.OperationalError as e:   # SQLite compilado sin FTS5 => se sigue con LIKE
+            print("[CART][FTS] no disponible:", e)
+            return
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, {collist}) VALUES (new.rowid, {new_vals}); END""")
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {collist}) VALUES ('delete', old.rowid, {old_vals}); END""")
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {collist}) VALUES ('delete', old.rowid, {old_vals});
+            INSERT INTO {fts}(rowid, {collist}) VALUES (new.rowid, {new_vals}); END""")
+        cur.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+def _has_table(con, name):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name=? LIMIT 1", (name,)).fetchone() is not None
+
+_NON_DIGITS = re.compile(r"[^\d]")
 
 def _price_to_int(v):
     if v is None: return 0
-    if isinstance(v, (int, float)): return int(v)
-    s = re.sub(r"[^\d]", "", str(v))
-    return int(s or 0)
+    if isinstance(v, int): return v
+    if isinstance(v, float): return int(v)
+    return _str_price_to_int(str(v))
+
+@lru_cache(maxsize=4096)
+def _str_price_to_int(s):
+    return int(_NON_DIGITS.sub("", s) or 0)
+
+# ---- Índice de prefijos en memoria (sugerencias sin ir a SQLite) ----
+class _PrefixIndex:
+    """Filas de pricelist de una región indexadas por SKU y por cada palabra del producto.
+
+    Claves en minúsculas, ordenadas; el prefijo se ubica con bisect y se recorre
+    hasta que deja de coincidir: O(log n + k), sin el costo de un trie de dicts en Python.
+    Se juntan todas las coincidencias antes de ordenar por SKU y cortar, igual que
+    `ORDER BY sku LIMIT ?` (cortar antes daría los primeros por clave, no por SKU).
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        pairs = []
+        for i, (sku, nombre, _precio) in enumerate(rows):
+            pairs.append(((sku or "").lower(), i))
+            pairs.extend((tok, i) for tok in (nombre or "").lower().split())
+        pairs.sort()
+        self.keys = [k for k, _ in pairs]
+        self.ids  = [i for _, i in pairs]
+
+    def prefix(self, term, limit):
+        t = term.lower()
+        keys, ids = self.keys, self.ids
+        hits = {}
+        i = bisect_left(keys, t)
+        while i < len(keys) and keys[i].startswith(t):
+            hits[ids[i]] = None
+            i += 1
+        return sorted((self.rows[j] for j in hits), key=lambda r: r[0] or "")[:limit]
+
+# ---- Filas reciclables (RecycleView reutiliza unas pocas instancias) ----
+Builder.load_string("""
+<SuggestionRow>:
+    markup: True
+    halign: "left"
+    valign: "middle"
+    text_size: self.width - dp(16), None
+""")
+
+class SuggestionRow(Button):
+    # estilo en la regla KV de arriba (se compila una vez, sin binds por instancia)
+    sku    = StringProperty("")
+    nombre = StringProperty("")
+    price  = NumericProperty(0)
+    screen = ObjectProperty(None, allownone=True)
+
+    def on_release(self):
+        if self.screen:
+            self.screen._pick_product(self.sku, self.nombre, self.price)
+
+class CartRow(BoxLayout):
+    text   = StringProperty("")
+    idx    = NumericProperty(0)
+    screen = ObjectProperty(None, allownone=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(spacing=8, **kwargs)
+        lbl = Label(markup=True, halign="left", valign="middle")
+        lbl.bind(size=lambda inst, *_: setattr(inst, "text_size", (inst.width - dp(8), None)))
+        self.bind(text=lbl.setter("text"))
+        self.add_widget(lbl)
+        for txt, fn in (("–", lambda: self.screen._chg_qty(self.idx, -1)),
+                        ("+", lambda: self.screen._chg_qty(self.idx, +1)),
+                        ("X", lambda: self.screen._del_item(self.idx))):
+            b = Button(text=txt, size_hint=(None,None), width=BTN_W, height=BTN_W)
+            b.bind(on_release=lambda *_, fn=fn: self.screen and fn())
+            self.add_widget(b)
+
+def _recycle_list(viewclass, size_hint):
+    rv = RecycleView(size_hint=size_hint, viewclass=viewclass)
+    lay = RecycleBoxLayout(orientation="vertical", size_hint_y=None, spacing=6, padding=(0,6),
+                           default_size=(None, ROW_H), default_size_hint=(1, None))
+    lay.bind(minimum_height=lay.setter("height"))
+    rv.add_widget(lay)
+    return rv
 
 class CartScreen(Screen):
-    # ---------- Helpers de UI ----------
-    def _wrap_button(self, text, on_release):
-        btn = Button(text=text, size_hint_y=None, height=ROW_MIN_H, halign="left", valign="middle")
-        btn.text_size = (0, None)
-        btn.bind(size=lambda inst, *_: setattr(inst, "text_size", (inst.width - dp(16), None)))
-        btn.bind(texture_size=lambda inst, *_: setattr(inst, "height", max(ROW_MIN_H, inst.texture_size[1] + dp(12))))
-        btn.bind(on_release=on_release)
-        return btn
-
-    def _wrap_label(self, text):
-        lbl = Label(text=text, size_hint_y=None, halign="left", valign="middle")
-        lbl.text_size = (0, None)
-        lbl.bind(size=lambda inst, *_: setattr(inst, "text_size", (inst.width - dp(8), None)))
-        lbl.bind(texture_size=lambda inst, *_: setattr(inst, "height", max(ROW_MIN_H, inst.texture_size[1] + dp(8))))
-        return lbl
+    # ---------- SQL (texto fijo => SQLite reutiliza el statement compilado) ----------
+    _SQL_SUGGEST = """
+        SELECT sku, reglas_de_lista_de_precios_producto, reglas_de_lista_de_precios_precio_fijo
+        FROM pricelist
+        WHERE region = ?
+          AND (sku LIKE ? ESCAPE '\\' OR reglas_de_lista_de_precios_producto LIKE ? ESCAPE '\\')
+        ORDER BY sku LIMIT ?
+    """
+    _SQL_REGION_PRICES = """
+        SELECT sku, reglas_de_lista_de_precios_producto, reglas_de_lista_de_precios_precio_fijo
+        FROM pricelist
+        WHERE region = ?
+    """
+    _SQL_SUGGEST_FTS = """
+        SELECT p.sku, p.reglas_de_lista_de_precios_producto, p.reglas_de_lista_de_precios_precio_fijo
+        FROM pricelist_fts f
+        JOIN pricelist p ON p.rowid = f.rowid
+        WHERE pricelist_fts MATCH ?
+          AND p.region = ?
+        ORDER BY p.sku LIMIT ?
+    """
+    _SQL_UPSERT_DRAFT = """
+        INSERT INTO order_drafts(user, cliente_rowid, payload_json, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user, cliente_rowid)
+        DO UPDATE SET payload_json=excluded.payload_json, updated_at=excluded.updated_at
+    """
+    _SQL_INS_ORDER_ITEM = """
+        INSERT INTO order_items(order_id, sku, product, unit_price, qty, total)
+        VALUES(?,?,?,?,?,?)
+    """
+    _SQL_INS_DETALLE = """
+        INSERT INTO detalle_productos_orden(
+            order_no, region, sku, product, marca, categoria, unit_price, qty, total
+        ) VALUES(?,?,?,?,?,?,?,?,?)
+    """
 
     # ---------- Ciclo ----------
     def on_pre_enter(self, *args):
         _ensure_tables()
+        if getattr(self, "_con", None) is None:
+            self._con = open_con()
+        self._has_fts = _has_table(self._con, "pricelist_fts")
+        self._prefix_idx = None   # se arma en la 1ª búsqueda (la región puede venir del borrador)
+        self._prefix_idx_region = None
         self.app = App.get_running_app()
         self.user = getattr(self.app, "current_user", "usuario")
 
@@ -135,7 +329,10 @@ class CartScreen(Screen):
         self.snap_forma_pago        = ctx.get("forma_pago")
         self.snap_dir_despacho      = ctx.get("direccion_despacho")
 
+        self._persist_ev = None
         self.cart = []
+        self._subtotal = 0       # suma de line_total, mantenida en cada mutación
+        self._cart_by_sku = {}   # sku -> mismo dict que está en self.cart
         self._build_ui()
 
         if ctx.get("from_draft"):
@@ -143,6 +340,17 @@ class CartScreen(Screen):
 
         self._refresh_totals()
 
+    def on_leave(self, *args):
+        ev = getattr(self, "_q_ev", None)
+        if ev:
+            ev.cancel(); self._q_ev = None
+        if getattr(self, "_persist_ev", None):
+            self._persist_draft_now()   # no perder el último cambio pendiente
+        con = getattr(self, "_con", None)
+        if con is not None:
+            con.close()
+            self._con = None
+
     def _go_back(self, *_):
         if self.manager:
             self.manager.transition = NoTransition()
@@ -156,18 +364,16 @@ class CartScreen(Screen):
         root.add_widget(Label(text=f"[b]Cliente:[/b] {self.cliente_display}",   markup=True, size_hint=(1,None), height=24))
 
         self.q = TextInput(hint_text="Buscar producto (SKU o descripción)…", size_hint=(1,None), height=44)
-        self.q.bind(text=lambda *_: self._suggest(self.q.text))
+        self._q_ev = None
+        self.q.bind(text=self._on_q_text)
         root.add_widget(self.q)
 
-        self.suggestions = GridLayout(cols=1, size_hint_y=None, spacing=6, padding=(0,6))
-        self.suggestions.bind(minimum_height=self.suggestions.setter("height"))
-        ssv = ScrollView(size_hint=(1, 0.38)); ssv.add_widget(self.suggestions)
-        root.add_widget(ssv)
+        self.suggestions = _recycle_list(SuggestionRow, (1, 0.38))
+        root.add_widget(self.suggestions)
 
-        self.cart_box = GridLayout(cols=1, size_hint_y=None, spacing=6, padding=(0,6))
-        self.cart_box.bind(minimum_height=self.cart_box.setter("height"))
-        csv = ScrollView(size_hint=(1, 0.34)); csv.add_widget(self.cart_box)
-        root.add_widget(csv)
+        self.cart_rv = _recycle_list(CartRow, (1, 0.34))
+        self._row_idx = {}   # sku -> índice de su fila en cart_rv.data
+        root.add_widget(self.cart_rv)
 
         self.lbl_sub = Label(text="Subtotal: $0", size_hint=(1,None), height=24)
         self.lbl_iva = Label(text="IVA (19%): $0", size_hint=(1,None), height=24)
@@ -183,116 +389,156 @@ class CartScreen(Screen):
         self.add_widget(root)
 
     # ---------- Sugerencias ----------
+    def _on_q_text(self, _inst, text):
+        if self._q_ev:
+            self._q_ev.cancel(); self._q_ev = None
+        if len((text or "").strip()) < 2:
+            self.suggestions.data = []
+            return
+        self._q_ev = Clock.schedule_once(lambda dt: self._suggest(self.q.text), DEBOUNCE_S)
+
     def _suggest(self, term):
-        self.suggestions.clear_widgets()
+        self._q_ev = None
+        self.suggestions.data = []
         t = (term or "").strip()
         if len(t) < 2: return
 
-        con = sqlite3.connect(_db_path()); cur = con.cursor()
-        like = f"%{t}%"
-        cur.execute("""
-            SELECT sku, reglas_de_lista_de_precios_producto, reglas_de_lista_de_precios_precio_fijo
-            FROM pricelist
-            WHERE region = ?
-              AND (sku LIKE ? OR reglas_de_lista_de_precios_producto LIKE ?)
-            ORDER BY sku LIMIT 50
-        """, (self.region, like, like))
-        rows = cur.fetchall(); con.close()
-
+        cur = self._con.cursor()
+        safe = like_escape(t)
+        if " " not in t:
+            # una palabra: prefijo de SKU / palabra del producto desde memoria
+            rows = self._region_index().prefix(t, SUGGEST_LIMIT)
+        else:
+            cur.execute(self._SQL_SUGGEST, (self.region, f"{safe}%", f"{safe}%", SUGGEST_LIMIT))
+            rows = cur.fetchall()
+        if len(rows) < SUGGEST_MIN_ROWS and not SUGGEST_STARTS_WITH:
+            if self._has_fts and len(t) >= 3:
+                cur.execute(self._SQL_SUGGEST_FTS, (fts_query(t), self.region, SUGGEST_LIMIT))
+            else:
+                cur.execute(self._SQL_SUGGEST, (self.region, f"%{safe}%", f"%{safe}%", SUGGEST_LIMIT))
+            # prefijo primero, luego el resto sin repetir
+            rows = list(dict.fromkeys(rows + cur.fetchall()))[:SUGGEST_LIMIT]
+
+        data = []
         for sku, nombre, precio in rows:
             p = _price_to_int(precio)
-            text = f"[b]{sku}[/b]\n{(nombre or '').strip()}   •   ${p:,}".replace(",", ".")
-            btn = self._wrap_button(text, on_release=lambda b, s=sku, n=nombre, pr=p: self._pick_product(s, n, pr))
-            btn.markup = True
-            self.suggestions.add_widget(btn)
+            text = f"[b]{sku}[/b]\n{(nombre or '').strip()}   •   {fmt_clp(p)}"
+            data.append({"text": text, "sku": sku, "nombre": nombre or "", "price": p, "screen": self})
+        self.suggestions.data = data
+
+    def _region_index(self):
+        if self._prefix_idx is None or self._prefix_idx_region != self.region:
+            rows = self._con.execute(self._SQL_REGION_PRICES, (self.region,)).fetchall()
+            self._prefix_idx = _PrefixIndex(rows)
+            self._prefix_idx_region = self.region
+        return self._prefix_idx
 
     def _pick_product(self, sku, nombre, unit_price):
         self._add_to_cart(sku, nombre, unit_price, qty=1)
 
     # ---------- Carrito ----------
     def _add_to_cart(self, sku, nombre, unit_price, qty=1):
-        for it in self.cart:
-            if it["sku"] == sku:
-                it["qty"] += int(qty)
-                break
+        it = self._cart_by_sku.get(sku)
+        if it:
+            self._set_qty(it, it["qty"] + int(qty))
         else:
-            self.cart.append({
+            it = {
                 "sku": sku,
                 "name": (nombre or "").strip(),
                 "unit_price": int(unit_price),
-                "qty": int(qty),
-            })
-        self._render_cart()
+                "qty": 0,
+                "line_total": 0,
+            }
+            self._set_qty(it, int(qty))
+            self.cart.append(it)
+            self._cart_by_sku[sku] = it
+        if sku in self._row_idx:
+            self._update_cart_row(it)                      # SKU repetido: solo cambia su texto
+        else:
+            self._append_cart_row(len(self.cart) - 1, it)  # SKU nuevo: una fila más al final
+            self._refresh_totals()
         self._persist_draft()
 
+    def _set_qty(self, it, qty):
+        """Fija la cantidad, recalcula el total de la línea y ajusta el subtotal acumulado."""
+        line_total = it["unit_price"] * qty
+        self._subtotal += line_total - it.get("line_total", 0)
+        it["qty"] = qty; it["line_total"] = line_total
+
+    @staticmethod
+    def _cart_row_text(it):
+        return (f"[b]{it['sku']}[/b]  {it['name']}\n"
+                f"{fmt_clp(it['unit_price'])}  ×{it['qty']}  =  [b]{fmt_clp(it['line_total'])}[/b]")
+
+    def _cart_row_data(self, idx, it):
+        return {"text": self._cart_row_text(it), "idx": idx, "screen": self}
+
+    def _append_cart_row(self, idx, it):
+        self.cart_rv.data.append(self._cart_row_data(idx, it))
+        self._row_idx[it["sku"]] = idx
+
+    def _update_cart_row(self, it):
+        """Refresca en sitio el texto de una fila y los totales (sin reconstruir el carrito)."""
+        idx = self._row_idx[it["sku"]]
+        self.cart_rv.data[idx] = self._cart_row_data(idx, it)
+        self._refresh_totals()
+
     def _render_cart(self):
-        self.cart_box.clear_widgets()
-        for idx, it in enumerate(self.cart):
-            row = BoxLayout(size_hint=(1,None), height=ROW_MIN_H + dp(12), spacing=8)
-
-            txt = (f"[b]{it['sku']}[/b]  {it['name']}\n"
-                   f"${it['unit_price']:,}  ×{it['qty']}  =  [b]${(it['unit_price']*it['qty']):,}[/b]").replace(",", ".")
-            lbl = self._wrap_label(txt); lbl.markup = True
-            row.add_widget(lbl)
-
-            menos = Button(text="–", size_hint=(None,None), width=BTN_W, height=BTN_W)
-            mas   = Button(text="+", size_hint=(None,None), width=BTN_W, height=BTN_W)
-            bor   = Button(text="X", size_hint=(None,None), width=BTN_W, height=BTN_W)
-            menos.bind(on_release=lambda *_ , i=idx: self._chg_qty(i, -1))
-            mas.bind(  on_release=lambda *_ , i=idx: self._chg_qty(i, +1))
-            bor.bind(  on_release=lambda *_ , i=idx: self._del_item(i))
-            row.add_widget(menos); row.add_widget(mas); row.add_widget(bor)
-
-            def _sync_height(*_):
-                row.height = max(ROW_MIN_H + dp(12), lbl.height + dp(12))
-            lbl.bind(height=lambda *_: _sync_height()); _sync_height()
-
-            self.cart_box.add_widget(row)
+        """Reconstrucción completa: solo al cargar borrador o al eliminar (los índices cambian)."""
+        self._row_idx = {it["sku"]: i for i, it in enumerate(self.cart)}
+        self.cart_rv.data = [self._cart_row_data(i, it) for i, it in enumerate(self.cart)]
         self._refresh_totals()
 
     def _chg_qty(self, idx, delta):
         if 0 <= idx < len(self.cart):
-            self.cart[idx]["qty"] = max(1, self.cart[idx]["qty"] + delta)
-            self._render_cart(); self._persist_draft()
+            self._set_qty(self.cart[idx], max(1, self.cart[idx]["qty"] + delta))
+            self._update_cart_row(self.cart[idx]); self._persist_draft()
 
     def _del_item(self, idx):
         if 0 <= idx < len(self.cart):
-            self.cart.pop(idx); self._render_cart(); self._persist_draft()
+            it = self.cart.pop(idx); self._cart_by_sku.pop(it["sku"], None)
+            self._subtotal -= it["line_total"]
+            self._render_cart(); self._persist_draft()
 
     def _refresh_totals(self):
-        sub = sum(it["unit_price"] * it["qty"] for it in self.cart)
+        sub = self._subtotal
         iva = int(round(sub * IVA)); tot = sub + iva
-        self.lbl_sub.text = f"Subtotal: ${sub:,}".replace(",", ".")
-        self.lbl_iva.text = f"IVA (19%): ${iva:,}".replace(",", ".")
-        self.lbl_tot.text = f"[b]Total:[/b] ${tot:,}".replace(",", ".")
+        self.lbl_sub.text = f"Subtotal: {fmt_clp(sub)}"
+        self.lbl_iva.text = f"IVA (19%): {fmt_clp(iva)}"
+        self.lbl_tot.text = f"[b]Total:[/b] {fmt_clp(tot)}"
 
     # ---------- Borradores ----------
     def _persist_draft(self):
+        if self._persist_ev:
+            self._persist_ev.cancel()
+        self._persist_ev = Clock.schedule_once(lambda dt: self._persist_draft_now(), PERSIST_DEBOUNCE_S)
+
+    def _persist_draft_now(self):
+        if self._persist_ev:
+            self._persist_ev.cancel(); self._persist_ev = None
         payload = {
             "mode": self.mode, "region": self.region,
             "cliente_rowid": self.cliente_rowid, "cliente_display": self.cliente_display,
             "cart": self.cart,
         }
-        _ensure_tables()
-        con = sqlite3.connect(_db_path()); cur = con.cursor()
-        cur.execute("""
-            INSERT INTO order_drafts(user, cliente_rowid, payload_json, updated_at)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user, cliente_rowid)
-            DO UPDATE SET payload_json=excluded.payload_json, updated_at=excluded.updated_at
-        """, (self.user, int(self.cliente_rowid or 0), json.dumps(payload), int(time.time())))
-        con.commit(); con.close()
+        cur = self._con.cursor()
+        cur.execute(self._SQL_UPSERT_DRAFT, (self.user, int(self.cliente_rowid or 0), _json_dumps(payload), int(time.time())))
+        invalidate_draft(self.user)
 
     def _load_draft(self):
-        con = sqlite3.connect(_db_path()); cur = con.cursor()
+        cur = self._con.cursor()
         cur.execute("SELECT payload_json FROM order_drafts WHERE user=? AND cliente_rowid=?",
                     (self.user, int(self.cliente_rowid or 0)))
-        row = cur.fetchone(); con.close()
+        row = cur.fetchone()
         if not row: return
-        data = json.loads(row[0])
+        data = _json_loads(row[0])
         self.mode            = data.get("mode")   or self.mode
         self.region          = data.get("region") or self.region
         self.cart            = data.get("cart")   or []
+        for it in self.cart:   # borradores antiguos no traen line_total
+            it["line_total"] = it["unit_price"] * it["qty"]
+        self._subtotal       = sum(it["line_total"] for it in self.cart)
+        self._cart_by_sku    = {it["sku"]: it for it in self.cart}
         self.cliente_display = data.get("cliente_display") or self.cliente_display
         self._build_ui(); self._render_cart()
 
@@ -300,62 +546,73 @@ class CartScreen(Screen):
     def _finalize_order(self):
         if not self.cart:
             return
+        if self._persist_ev:   # guardar lo pendiente: si la transacción falla, el borrador queda al día
+            self._persist_draft_now()   # (si sale bien, el DELETE de abajo lo borra igual)
 
-        order_no = f"{self.user}{random.randint(10000, 99999)}"
-        sub = sum(it["unit_price"] * it["qty"] for it in self.cart)
+        sub = self._subtotal
         iva = int(round(sub * IVA)); tot = sub + iva
 
-        _ensure_tables()
-        con = sqlite3.connect(_db_path()); cur = con.cursor()
-
-        # nombre real del usuario (para "Realizado por")
-        cur.execute("SELECT nombre_real FROM usuarios WHERE username_ferro=? LIMIT 1", (self.user,))
-        row_user = cur.fetchone()
-        realizado_por_nombre = (row_user[0] if row_user and row_user[0] not in (None, "") else self.user)
-
-        # INSERT dinámico a prueba de conteo
-        cols = [
-            "order_no","user","cliente_rowid","cliente_display","mode","region",
-            "subtotal","iva","total","created_at",
-            "cliente_rut","cliente_direccion","cliente_comuna","cliente_ciudad",
-            "cliente_estado","cliente_email","forma_pago","direccion_despacho",
-            "realizado_por_usuario","realizado_por_nombre",
-        ]
-        params = [
-            order_no, self.user, int(self.cliente_rowid or 0), self.cliente_display, self.mode, self.region,
-            sub, iva, tot, int(time.time()),
-            self.snap_cliente_rut, self.snap_cliente_dir, self.snap_cliente_comuna, self.snap_cliente_ciudad,
-            self.snap_cliente_estado, self.snap_cliente_email, self.snap_forma_pago, self.snap_dir_despacho,
-            self.user, realizado_por_nombre,
-        ]
-        ph = ",".join(["?"] * len(cols))
-        sql = f"INSERT INTO orders({','.join(cols)}) VALUES({ph})"
-        print("[CART][DEBUG] placeholders:", sql.count("?"), "values:", len(params))
-        cur.execute(sql, params)
-        order_id = cur.lastrowid
-
-        # Detalle por línea (compatibilidad + tabla para PDF)
-        for it in self.cart:
-            cur.execute("""
-                INSERT INTO order_items(order_id, sku, product, unit_price, qty, total)
-                VALUES(?,?,?,?,?,?)
-            """, (order_id, it["sku"], it["name"], it["unit_price"], it["qty"], it["unit_price"] * it["qty"]))
-
-            cur.execute("SELECT marca, categoria_de_producto FROM productos WHERE sku=? LIMIT 1", (it["sku"],))
-            row_prod = cur.fetchone()
-            marca = row_prod[0] if row_prod and row_prod[0] not in (None, "") else None
-            categoria = row_prod[1] if row_prod and row_prod[1] not in (None, "") else None
-
-            cur.execute("""
-                INSERT INTO detalle_productos_orden(
-                    order_no, region, sku, product, marca, categoria, unit_price, qty, total
-                ) VALUES(?,?,?,?,?,?,?,?,?)
-            """, (order_no, self.region, it["sku"], it["name"], marca, categoria,
-                  int(it["unit_price"]), int(it["qty"]), int(it["unit_price"] * it["qty"])))
-
-        # limpiar completamente el borrador de ordenes y volver
-        cur.execute("DELETE FROM order_drafts WHERE user=?", (self.user,))
-        con.commit(); con.close()
+        cur = self._con.cursor()
+
+        # Una sola transacción: cabecera + líneas + borrado del borrador => un único fsync
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # nombre real del usuario (para "Realizado por")
+            cur.execute("SELECT nombre_real FROM usuarios WHERE username_ferro=? LIMIT 1", (self.user,))
+            row_user = cur.fetchone()
+            realizado_por_nombre = (row_user[0] if row_user and row_user[0] not in (None, "") else self.user)
+
+            # INSERT dinámico a prueba de conteo
+            cols = [
+                "order_no","user","cliente_rowid","cliente_display","mode","region",
+                "subtotal","iva","total","created_at",
+                "cliente_rut","cliente_direccion","cliente_comuna","cliente_ciudad",
+                "cliente_estado","cliente_email","forma_pago","direccion_despacho",
+                "realizado_por_usuario","realizado_por_nombre",
+            ]
+            params = [
+                "", self.user, int(self.cliente_rowid or 0), self.cliente_display, self.mode, self.region,
+                sub, iva, tot, int(time.time()),
+                self.snap_cliente_rut, self.snap_cliente_dir, self.snap_cliente_comuna, self.snap_cliente_ciudad,
+                self.snap_cliente_estado, self.snap_cliente_email, self.snap_forma_pago, self.snap_dir_despacho,
+                self.user, realizado_por_nombre,
+            ]
+            ph = ",".join(["?"] * len(cols))
+            sql = f"INSERT INTO orders({','.join(cols)}) VALUES({ph})"
+            print("[CART][DEBUG] placeholders:", sql.count("?"), "values:", len(params))
+            cur.execute(sql, params)
+            order_id = cur.lastrowid
+            # nº de orden determinista a partir del rowid (sin colisiones como el random previo)
+            order_no = f"{self.user}-{order_id:06d}"
+            cur.execute("UPDATE orders SET order_no=? WHERE id=?", (order_no, order_id))
+
+            # marca/categoría de todos los SKU del carrito en una sola consulta
+            skus = list(dict.fromkeys(it["sku"] for it in self.cart))
+            ph = ",".join("?" * len(skus))
+            cur.execute(f"SELECT sku, marca, categoria_de_producto FROM productos WHERE sku IN ({ph})", skus)
+            meta = {}
+            for sku, marca, categoria in cur.fetchall():
+                meta.setdefault(sku, (marca or None, categoria or None))   # 1ª fila por SKU (como el LIMIT 1 previo)
+
+            # Detalle por línea (compatibilidad + tabla para PDF)
+            items_rows, detalle_rows = [], []
+            for it in self.cart:
+                items_rows.append((order_id, it["sku"], it["name"], it["unit_price"], it["qty"], it["line_total"]))
+                marca, categoria = meta.get(it["sku"], (None, None))
+
+                detalle_rows.append((order_no, self.region, it["sku"], it["name"], marca, categoria,
+                                     int(it["unit_price"]), int(it["qty"]), int(it["line_total"])))
+
+            cur.executemany(self._SQL_INS_ORDER_ITEM, items_rows)
+            cur.executemany(self._SQL_INS_DETALLE, detalle_rows)
+
+            # limpiar completamente el borrador de ordenes y volver
+            cur.execute("DELETE FROM order_drafts WHERE user=?", (self.user,))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        invalidate_draft(self.user)
 
         if self.manager:
             self.manager.transition = NoTransition()
@@ -0,0 +1,44 @@
+# db_utils.py
+# Helpers de SQLite y formato compartidos por las pantallas (carrito, historial, tomar_pedido):
+# una sola copia, para que la búsqueda y los montos se comporten igual en todas.
+import os, sqlite3
+from functools import lru_cache
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bd_sqlite", "todoferre.db")
+
+
+def open_con(path=DB_PATH):
+    """Conexión de larga vida para una pantalla (autocommit + WAL)."""
+    con = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+
+@lru_cache(maxsize=4096)
+def fmt_clp(n):
+    """12345 -> '$12.345' (miles con punto)."""
+    return f"${n:,}".replace(",", ".")
+
+
+def like_escape(term):
+    """Escapa \\, % y _ para usar el término literal en `LIKE ? ESCAPE '\\'`."""
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def fts_query(term):
+    """'llave 3/4' -> '"llave"* "3/4"*' (prefijo por token, comillas escapadas)."""
+    return " ".join('"' + t.replace('"', '""') + '"*' for t in term.split())
+
+
+# lower() de SQLite (sin ICU) solo pasa A-Z a minúsculas; el rango debe doblar igual
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def prefix_range(term):
+    """'Ferre' -> ('ferre', 'ferrf'): `lower(col) >= lo AND lower(col) < hi` equivale a
+    "empieza con" y sí usa los índices sobre lower(col) (LIKE no los aprovecha).
+    Solo se dobla ASCII, como lower() de SQLite: 'Ñandú' queda 'Ñandú' y sigue calzando."""
+    lo = term.translate(_ASCII_LOWER)
+    return lo, lo[:-1] + chr(ord(lo[-1]) + 1)
@@ -1,5 +1,6 @@
 # historial.py
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.screenmanager import Screen
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
@@ -11,8 +12,10 @@ from kivy.uix.popup import Popup
 from kivy.metrics import dp
 from kivy.utils import platform
 
-import sqlite3, os, time, sys, webbrowser
+import os, time, sys, threading, webbrowser
+from functools import lru_cache
 
+from db_utils import fmt_clp, fts_query, like_escape, open_con, prefix_range
 # PDF
 from pdf_pedido import export_order_pdf
 
@@ -26,13 +29,24 @@ if platform == "android":
         _autoclass = None
         _cast = None
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "bd_sqlite", "todoferre.db")
+DEBOUNCE_S = 0.25   # espera tras la última tecla antes de consultar
+
+
+@lru_cache(maxsize=1024)
+def _fmt_ts(minute_bucket):
+    """Fecha local 'YYYY-mm-dd HH:MM' de un minuto (ts // 60); se muestra sin segundos."""
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(minute_bucket * 60))
 
 
 class HistoryScreen(Screen):
     def on_pre_enter(self, *args):
         self.clear_widgets()
         self.user = getattr(App.get_running_app(), "current_user", "usuario")
+        if getattr(self, "_con", None) is None:
+            self._con = open_con()
+        # clientes_fts lo crea/sincroniza tomar_pedido._ensure_clientes_fts (si el SQLite trae FTS5)
+        self._has_fts = self._con.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='clientes_fts' LIMIT 1").fetchone() is not None
 
         root = BoxLayout(orientation="vertical", padding=10, spacing=8)
 
@@ -47,7 +61,8 @@ class HistoryScreen(Screen):
             hint_text="Buscar por nombre, fantasía, RUT u orden…",
             multiline=False, size_hint=(1, None), height=dp(44)
         )
-        self.q.bind(text=lambda *_: self._reload())
+        self._q_ev = None
+        self.q.bind(text=self._on_q_text)
         root.add_widget(self.q)
 
         # 👇 salto de línea / espacio visual
@@ -68,10 +83,19 @@ class HistoryScreen(Screen):
         self.add_widget(root)
         self._reload()
 
+    def on_leave(self, *args):
+        ev = getattr(self, "_q_ev", None)
+        if ev:
+            ev.cancel(); self._q_ev = None
+        con = getattr(self, "_con", None)
+        if con is not None:
+            con.close()
+            self._con = None
+
     # ---------- Helpers UI ----------
     def _add_row(self, order_no: str, cliente: str, total: int, ts: int):
-        fecha = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
-        total_fmt = f"${int(total):,}".replace(",", ".")
+        fecha = _fmt_ts(int(ts) // 60)
+        total_fmt = fmt_clp(int(total))
         txt = f"[b]{order_no}[/b]  ·  {cliente}\n{total_fmt}  ·  {fecha}"
 
         row = BoxLayout(orientation="horizontal", size_hint_y=None, height=dp(60), spacing=dp(8))
@@ -124,33 +148,58 @@ class HistoryScreen(Screen):
             pass
 
     def _generate_pdf(self, order_no: str):
+        """Genera el PDF en un hilo aparte; la UI solo muestra 'Generando…' mientras tanto."""
+        self._pdf_wait = Popup(title="PDF", content=Label(text=f"Generando PDF de {order_no}…"),
+                               size_hint=(0.8, 0.3), auto_dismiss=False)
+        self._pdf_wait.open()
+        threading.Thread(target=self._pdf_worker, args=(order_no,), daemon=True).start()
+
+    def _pdf_worker(self, order_no: str):
+        # Corre fuera del hilo de Kivy: nada de widgets aquí, solo Clock para volver
         try:
             pdf_path = export_order_pdf(order_no)
-            # Popup con 2 botones
-            content = BoxLayout(orientation="vertical", padding=dp(12), spacing=dp(10))
-            content.add_widget(Label(text=f"Archivo creado:\n{pdf_path}", halign="center", valign="middle", size_hint=(1, 1)))
-            btns = BoxLayout(size_hint=(1, None), height=dp(44), spacing=dp(8))
-            abrir = Button(text="Abrir PDF")
-            cerrar = Button(text="Cerrar")
-            btns.add_widget(abrir); btns.add_widget(cerrar)
-            content.add_widget(btns)
-
-            popup = Popup(title="PDF generado", content=content, size_hint=(0.85, 0.5), auto_dismiss=False)
-            abrir.bind(on_release=lambda *_: (popup.dismiss(), self._open_file(pdf_path)))
-            cerrar.bind(on_release=lambda *_: popup.dismiss())
-            popup.open()
         except Exception as e:
-            # En caso de error mostramos un popup simple
-            Popup(title="Error",
-                  content=Label(text=str(e)),
-                  size_hint=(0.8, 0.4)).open()
+            msg = str(e)
+            Clock.schedule_once(lambda dt: self._show_pdf_error(msg))
+            return
+        Clock.schedule_once(lambda dt: self._show_pdf_popup(pdf_path))
+
+    def _show_pdf_popup(self, pdf_path: str):
+        self._pdf_wait.dismiss()
+        # Popup con 2 botones
+        content = BoxLayout(orientation="vertical", padding=dp(12), spacing=dp(10))
+        content.add_widget(Label(text=f"Archivo creado:\n{pdf_path}", halign="center", valign="middle", size_hint=(1, 1)))
+        btns = BoxLayout(size_hint=(1, None), height=dp(44), spacing=dp(8))
+        abrir = Button(text="Abrir PDF")
+        cerrar = Button(text="Cerrar")
+        btns.add_widget(abrir); btns.add_widget(cerrar)
+        content.add_widget(btns)
+
+        popup = Popup(title="PDF generado", content=content, size_hint=(0.85, 0.5), auto_dismiss=False)
+        abrir.bind(on_release=lambda *_: (popup.dismiss(), self._open_file(pdf_path)))
+        cerrar.bind(on_release=lambda *_: popup.dismiss())
+        popup.open()
+
+    def _show_pdf_error(self, msg: str):
+        self._pdf_wait.dismiss()
+        # En caso de error mostramos un popup simple
+        Popup(title="Error",
+              content=Label(text=msg),
+              size_hint=(0.8, 0.4)).open()
 
     # ---------- Carga/consulta ----------
+    def _on_q_text(self, *_):
+        # término vacío = listado completo, así que aquí no se filtra por largo
+        if self._q_ev:
+            self._q_ev.cancel()
+        self._q_ev = Clock.schedule_once(lambda dt: self._reload(), DEBOUNCE_S)
+
     def _reload(self):
+        self._q_ev = None
         term = (self.q.text or "").strip()
-        like = f"%{term}%"
+        like = f"%{like_escape(term)}%"
 
-        con = sqlite3.connect(DB_PATH); cur = con.cursor()
+        cur = self._con.cursor()
         try:
             if term == "":
                 cur.execute("""
@@ -160,26 +209,40 @@ class HistoryScreen(Screen):
                     ORDER BY o.id DESC
                     LIMIT 200
                 """, (self.user,))
+            elif self._has_fts and len(term) >= 3:
+                cur.execute("""
+                    SELECT o.order_no, o.cliente_display, o.total, o.created_at
+                    FROM orders o
+                    WHERE o.user=?
+                      AND (
+                           o.order_no LIKE ? ESCAPE '\\' COLLATE NOCASE
+                        OR o.cliente_display LIKE ? ESCAPE '\\' COLLATE NOCASE
+                        OR o.cliente_rowid IN (SELECT rowid FROM clientes_fts WHERE clientes_fts MATCH ?)
+                      )
+                    ORDER BY o.id DESC
+                    LIMIT 200
+                """, (self.user, like, like, fts_query(term)))
             else:
                 cur.execute("""
                     SELECT o.order_no, o.cliente_display, o.total, o.created_at
                     FROM orders o
-                    LEFT JOIN clientes c ON c.rowid = o.cliente_rowid
                     WHERE o.user=?
                       AND (
-                           o.order_no LIKE ? COLLATE NOCASE
-                        OR o.cliente_display LIKE ? COLLATE NOCASE
-                        OR c.nombre_fantasia LIKE ? COLLATE NOCASE
-                        OR c.nombre_completo LIKE ? COLLATE NOCASE
-                        OR c.numero_identificacion_fiscal LIKE ? COLLATE NOCASE
+                           o.order_no LIKE ? ESCAPE '\\' COLLATE NOCASE
+                        OR o.cliente_display LIKE ? ESCAPE '\\' COLLATE NOCASE
+                        OR o.cliente_rowid IN (
+                                 SELECT rowid FROM clientes WHERE lower(nombre_fantasia) >= ? AND lower(nombre_fantasia) < ?
+                           UNION SELECT rowid FROM clientes WHERE lower(nombre_completo) >= ? AND lower(nombre_completo) < ?
+                           UNION SELECT rowid FROM clientes WHERE lower(numero_identificacion_fiscal) >= ? AND lower(numero_identificacion_fiscal) < ?
+                        )
                       )
                     ORDER BY o.id DESC
                     LIMIT 200
-                """, (self.user, like, like, like, like, like))
+                """, (self.user, like, like, *prefix_range(term) * 3))
 
             rows = cur.fetchall()
         finally:
-            con.close()
+            cur.close()
 
         self.grid.clear_widgets()
         if not rows:
@@ -0,0 +1,33 @@
+# Rango de prefijo de db_utils contra lower() real de SQLite (sin Kivy: solo helpers).
+import os, sqlite3, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_utils import prefix_range
+
+NOMBRES = ["Ñandú Ltda", "Ñoño SpA", "Álamos Ferretería", "Élite Pinturas", "ferreteria Sur", "Ferrex", "Nogal"]
+
+
+def _buscar(term):
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE clientes (nombre TEXT)")
+    con.executemany("INSERT INTO clientes VALUES (?)", [(n,) for n in NOMBRES])
+    lo, hi = prefix_range(term)
+    rows = con.execute("SELECT nombre FROM clientes WHERE lower(nombre) >= ? AND lower(nombre) < ? ORDER BY nombre", (lo, hi))
+    return [r[0] for r in rows]
+
+
+def test_prefijo_ascii_ignora_mayusculas():
+    assert _buscar("FERRE") == ["Ferrex", "ferreteria Sur"]
+
+
+def test_prefijo_primera_letra_no_ascii():
+    assert _buscar("Ñan") == ["Ñandú Ltda"]
+    assert _buscar("Ñ") == ["Ñandú Ltda", "Ñoño SpA"]
+    assert _buscar("Ál") == ["Álamos Ferretería"]
+    assert _buscar("élite") == []  # lower() de SQLite no dobla É, igual que LIKE ... COLLATE NOCASE
+    assert _buscar("Élite") == ["Élite Pinturas"]
+
+
+def test_prefijo_no_ascii_tras_ascii():
+    assert _buscar("ÑAND") == ["Ñandú Ltda"]
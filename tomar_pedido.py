@@ -3,11 +3,15 @@ from __future__ import annotations
 
 import json
 import sqlite3
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
 
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.metrics import dp
 from kivy.properties import StringProperty
 from kivy.uix.boxlayout import BoxLayout
@@ -18,14 +22,252 @@ from kivy.uix.screenmanager import NoTransition, Screen
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.textinput import TextInput
 
+from db_utils import fts_query
+
 print("[TP] Cargando módulo desde:", __file__)
 
 # Ruta de la base de datos
 DB_PATH = Path("bd_sqlite/todoferre.db").expanduser().resolve()
 
+# Espera tras la última tecla antes de buscar (segundos)
+SEARCH_DEBOUNCE_S = 0.15
+
+# Máximo de resultados mostrados (= botones pre-creados en la lista)
+RESULTS_MAX = 30
+RESULT_H = dp(48)
+
+# Un solo hilo para las búsquedas: la UI no se congela si SQLite tarda (checkpoint WAL, disco frío)
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search_clients")
+
+# Conexiones del módulo (se abren en el primer uso y no se cierran):
+#  - _RW_CONN: escritura (crea índices / espejos FTS de 'clientes'); _CONN_LOCK evita que la UI
+#    y el hilo de búsqueda la abran (y preparen el esquema) dos veces a la vez
+#  - _RO: solo lectura (mode=ro) para búsquedas y lecturas de borradores, UNA POR HILO: el hilo
+#    de _SEARCH_POOL y la UI nunca comparten conexión. En WAL no compiten con quien escribe
+#    (carrito) ni piden locks de escritura
+_RW_CONN: Optional[sqlite3.Connection] = None
+_CONN_LOCK = threading.Lock()
+_RO = threading.local()
+
+_READ_PRAGMAS = """
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-20000;
+    PRAGMA busy_timeout=5000;
+    PRAGMA mmap_size=268435456;
+"""
+
+
+def _get_conn() -> sqlite3.Connection:
+    global _RW_CONN
+    with _CONN_LOCK:
+        if _RW_CONN is None:
+            con = sqlite3.connect(DB_PATH, check_same_thread=False)
+            con.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+            """ + _READ_PRAGMAS)
+            _ensure_clientes_fts(con)
+            _ensure_clientes_nocase_idx(con)
+            _RW_CONN = con  # se publica recién con el esquema listo
+    return _RW_CONN
+
+
+def _get_ro_conn() -> sqlite3.Connection:
+    """Conexión de lectura del hilo actual (cada hilo abre la suya en el primer uso)."""
+    con = getattr(_RO, "con", None)
+    if con is None:
+        _get_conn()  # el esquema (FTS, índices) lo deja listo la conexión de escritura
+        con = sqlite3.connect(f"{DB_PATH.as_uri()}?mode=ro", uri=True)
+        con.executescript(_READ_PRAGMAS)
+        _RO.con = con
+    return con
+
+
+# Borrador más reciente por usuario: user -> (PRAGMA data_version, cliente_rowid, payload_json).
+# carrito.py llama invalidate_draft() al escribir/borrar; data_version cubre cualquier otro escritor.
+# data_version es por conexión: _latest_draft solo corre en el hilo de la UI (su conexión de lectura).
+_DRAFT_CACHE: Dict[str, Tuple[int, Optional[int], Optional[str]]] = {}
+
+
+def invalidate_draft(user: Optional[str] = None) -> None:
+    """Olvida el borrador cacheado de 'user' (o de todos si user es None)."""
+    if user is None:
+        _DRAFT_CACHE.clear()
+    else:
+        _DRAFT_CACHE.pop(user, None)
+
+
+def _latest_draft(user: str) -> Tuple[Optional[int], Optional[str]]:
+    """(cliente_rowid, payload_json) del último borrador de 'user'; (None, None) si no hay."""
+    con = _get_ro_conn()
+    version = con.execute("PRAGMA data_version").fetchone()[0]
+    hit = _DRAFT_CACHE.get(user)
+    if hit is not None and hit[0] == version:
+        return hit[1], hit[2]
+    row = con.execute("""
+        SELECT cliente_rowid, payload_json
+        FROM order_drafts
+        WHERE user=?
+        ORDER BY id DESC
+        LIMIT 1
+    """, (user,)).fetchone()
+    rowid, payload = (int(row[0] or 0), row[1]) if row else (None, None)
+    _DRAFT_CACHE[user] = (version, rowid, payload)
+    return rowid, payload
+
+
+_FTS_COLS = ("nombre_fantasia", "nombre_completo", "numero_identificacion_fiscal")
+
+
+# nombre de la tabla espejo -> tokenizer FTS5
+#  - clientes_fts:  palabras (prefijo por palabra, sin tildes)
+#  - clientes_trgm: trigramas => cualquier subcadena (RUT tecleado "por la mitad"); SQLite >= 3.34
+_FTS_MIRRORS = (
+    ("clientes_fts", "unicode61 remove_diacritics 2"),
+    ("clientes_trgm", "trigram"),
+)
+
+
+def _ensure_clientes_fts(conn: sqlite3.Connection) -> None:
+    """
+    Espejos FTS5 (contenido externo) de 'clientes' + triggers de sincronización.
+    Se crean una sola vez; si 'clientes' no existe o SQLite no trae el tokenizer, se sigue con LIKE.
+    """
+    exists = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if "clientes" not in exists:
+        return
+    if not set(_FTS_COLS) <= {r[1] for r in conn.execute("PRAGMA table_info(clientes)")}:
+        return
+    cols = ", ".join(_FTS_COLS)
+    new_vals = ", ".join(f"new.{c}" for c in _FTS_COLS)
+    old_vals = ", ".join(f"old.{c}" for c in _FTS_COLS)
+    for fts, tokenize in _FTS_MIRRORS:
+        if fts in exists:
+            continue
+        try:
+            with conn:
+                conn.execute(f"""
+                    CREATE VIRTUAL TABLE {fts} USING fts5(
+                        {cols}, content='clientes', content_rowid='rowid',
+                        tokenize='{tokenize}')
+                """)
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON clientes BEGIN
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.rowid, {new_vals}); END""")
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON clientes BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.rowid, {old_vals}); END""")
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON clientes BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.rowid, {old_vals});
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.rowid, {new_vals}); END""")
+                conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            print(f"[SEARCH_CLIENTS][FTS] {fts} no disponible:", e)
+
+
+def _ensure_clientes_nocase_idx(conn: sqlite3.Connection) -> None:
+    """Índices NOCASE: 'col LIKE "tok%"' (sin comodín inicial) pasa a ser un range scan."""
+    try:
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(clientes)")}
+        with conn:
+            for c in _FTS_COLS:
+                if c in cols:
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS ix_clientes_{c}_nocase ON clientes({c} COLLATE NOCASE)")
+    except sqlite3.OperationalError as e:
+        print("[SEARCH_CLIENTS] índices NOCASE no creados:", e)
+
+
+def _trgm_query(term: str) -> str:
+    """Subcadena literal como frase: '345.678' -> '"345.678"'."""
+    return '"' + term.replace('"', '""') + '"'
+
+
+@lru_cache(maxsize=None)
+def _clientes_columns() -> FrozenSet[str]:
+    """Columnas reales de 'clientes' (el esquema no cambia en runtime: una vez por proceso)."""
+    return frozenset(row[1] for row in _get_ro_conn().execute("PRAGMA table_info(clientes)"))
+
 
 # --------------------------- BÚSQUEDA EN SQLITE ---------------------------
 
+@lru_cache(maxsize=None)
+def _build_search_sql() -> Optional[Tuple[str, Tuple[str, ...], Dict[str, str]]]:
+    """
+    Arma UNA vez el SELECT de búsqueda según las columnas reales de 'clientes'.
+    Devuelve (SELECT ... FROM clientes, columnas para LIKE, {espejo FTS existente: sql}) o
+    None si no hay columnas para buscar.
+    El texto queda fijo, así SQLite reutiliza el statement compilado en cada tecla.
+    """
+    cols = _clientes_columns()
+
+    want = [
+        "nombre_fantasia", "nombre_completo", "comuna",
+        "ciudad", "email", "numero_identificacion_fiscal"
+    ]
+
+    # SELECT seguro con alias si falta columna
+    select_parts = []
+    for c in want:
+        if c == "email":
+            if "correo_electronico" in cols:
+                select_parts.append("correo_electronico AS email")
+            elif "email" in cols:
+                select_parts.append("email")
+            else:
+                select_parts.append("'' AS email")
+        else:
+            select_parts.append(c if c in cols else f"'' AS {c}")
+    select_clause = ", ".join(select_parts)
+
+    # Preferencia para 'display'
+    if "nombre_fantasia" in cols and "nombre_completo" in cols:
+        display_expr = "COALESCE(NULLIF(TRIM(nombre_fantasia),''), nombre_completo)"
+    elif "nombre_fantasia" in cols:
+        display_expr = "nombre_fantasia"
+    elif "nombre_completo" in cols:
+        display_expr = "nombre_completo"
+    else:
+        return None
+
+    like_cols = tuple(c for c in _FTS_COLS if c in cols)
+    if not like_cols:
+        return None
+
+    head = f"""
+    SELECT
+        {display_expr} AS display,
+        {select_clause},
+        rowid AS cliente_id
+    FROM clientes
+    """
+
+    fts_sql: Dict[str, str] = {}
+    for fts, _tok in _FTS_MIRRORS:
+        if _get_ro_conn().execute("SELECT 1 FROM sqlite_master WHERE name=?", (fts,)).fetchone():
+            # los mejores 'limit' por relevancia, mostrados en el mismo orden que el LIKE
+            fts_sql[fts] = f"""{head}
+            WHERE rowid IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ? ORDER BY rank LIMIT ?)
+            ORDER BY display
+            """
+    return head, like_cols, fts_sql
+
+
+@lru_cache(maxsize=None)
+def _build_like_sql(n_tokens: int) -> Optional[str]:
+    """
+    SELECT LIKE para 'n_tokens' palabras (un statement fijo por cantidad de palabras).
+    La 1ª palabra va como prefijo 'tok%' (usa los índices NOCASE); el resto como '%tok%'.
+    """
+    built = _build_search_sql()
+    if built is None:
+        return None
+    head, like_cols, _fts = built
+    any_col = "(" + " OR ".join(f"{c} LIKE ?" for c in like_cols) + ")"
+    return f"""{head}
+    WHERE {' AND '.join([any_col] * n_tokens)}
+    ORDER BY display
+    LIMIT ?
+    """
+
+
 def search_clients(term: str, limit: int = 30) -> List[Dict[str, Any]]:
     """
     Busca en la tabla 'clientes' por nombre_fantasia / nombre_completo / RUT.
@@ -38,98 +280,63 @@ def search_clients(term: str, limit: int = 30) -> List[Dict[str, Any]]:
         print("[SEARCH_CLIENTS] DB no existe:", DB_PATH)
         return []
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
     try:
-        cur = conn.cursor()
-
-        # Descubrir columnas reales
-        cur.execute("PRAGMA table_info(clientes)")
-        cols = {row["name"] for row in cur.fetchall()}
-
-        want = [
-            "nombre_fantasia", "nombre_completo", "comuna",
-            "ciudad", "email", "numero_identificacion_fiscal"
-        ]
-
-        # SELECT seguro con alias si falta columna
-        select_parts = []
-        for c in want:
-            if c == "email":
-                if "correo_electronico" in cols:
-                    select_parts.append("correo_electronico AS email")
-                elif "email" in cols:
-                    select_parts.append("email")
-                else:
-                    select_parts.append("'' AS email")
-            else:
-                select_parts.append(c if c in cols else f"'' AS {c}")
-        select_clause = ", ".join(select_parts)
-
-        # Preferencia para 'display'
-        if "nombre_fantasia" in cols and "nombre_completo" in cols:
-            display_expr = "COALESCE(NULLIF(TRIM(nombre_fantasia),''), nombre_completo)"
-        elif "nombre_fantasia" in cols:
-            display_expr = "nombre_fantasia"
-        elif "nombre_completo" in cols:
-            display_expr = "nombre_completo"
-        else:
-            return []
-
-        like = f"%{(term or '').strip()}%"
-        where_terms, params = [], []
-        if "nombre_fantasia" in cols:
-            where_terms.append("nombre_fantasia LIKE ? COLLATE NOCASE")
-            params.append(like)
-        if "nombre_completo" in cols:
-            where_terms.append("nombre_completo LIKE ? COLLATE NOCASE")
-            params.append(like)
-        if "numero_identificacion_fiscal" in cols:
-            where_terms.append("numero_identificacion_fiscal LIKE ? COLLATE NOCASE")
-            params.append(like)
-
-        if not where_terms:
-            return []
-
-        sql = f"""
-        SELECT
-            {display_expr} AS display,
-            {select_clause},
-            rowid AS cliente_id
-        FROM clientes
-        WHERE {' OR '.join(where_terms)}
-        ORDER BY display
-        LIMIT ?
-        """
-        params.append(limit)
-
-        cur.execute(sql, params)
-        rows = cur.fetchall()
-
-        results: List[Dict[str, Any]] = []
-        for r in rows:
-            results.append({
-                "display": r["display"] or "",
-                "nombre_fantasia": r["nombre_fantasia"] or "",
-                "nombre_completo": r["nombre_completo"] or "",
-                "comuna": r["comuna"] or "",
-                "ciudad": r["ciudad"] or "",
-                "email": r["email"] or "",
-                "cliente_id": r["cliente_id"],
-                "numero_identificacion_fiscal": r["numero_identificacion_fiscal"] or "",
-            })
-        print(f"[SUGGEST] {len(results)} resultados para '{term}'")
-        return results
-
+        # 'clientes' lo llena una sincronización externa: si la BD cambió desde la última
+        # búsqueda de este hilo (data_version es por conexión), el caché ya no vale
+        version = _get_ro_conn().execute("PRAGMA data_version").fetchone()[0]
+        if getattr(_RO, "search_version", None) != version:
+            _search_clients_cached.cache_clear()
+            _RO.search_version = version
+        cached = _search_clients_cached((term or "").strip(), limit)
     except Exception as e:
+        # las excepciones no quedan en el caché: el próximo intento vuelve a consultar
         print("[SEARCH_CLIENTS][ERROR]", e)
         return []
-    finally:
-        conn.close()
+    # copias: quien llama puede modificar los dicts sin tocar el caché
+    results = [dict(r) for r in cached]
+    print(f"[SUGGEST] {len(results)} resultados para '{term}'")
+    return results
+
+
+@lru_cache(maxsize=256)
+def _search_clients_cached(norm_term: str, limit: int) -> Tuple[Dict[str, Any], ...]:
+    """
+    Resultado de búsqueda por término (sin espacios extremos).
+    Borrar/retomar "jua" -> "juan" -> "jua" no vuelve a SQLite. No se pasa a minúsculas:
+    LIKE solo ignora mayúsculas en ASCII y "ÑUÑOA" dejaría de encontrar "ñuñoa".
+    search_clients() lo vacía cuando cambia PRAGMA data_version (escrituras de cualquier proceso).
+    """
+    built = _build_search_sql()
+    if built is None:
+        return ()
+    _head, like_cols, fts_sql = built
+
+    cur = _get_ro_conn().cursor()
+    if len(norm_term) >= 3 and "clientes_trgm" in fts_sql and any(ch.isdigit() for ch in norm_term):
+        # RUT / dígitos: subcadena exacta vía trigramas
+        cur.execute(fts_sql["clientes_trgm"], (_trgm_query(norm_term), limit))
+    elif len(norm_term) >= 3 and "clientes_fts" in fts_sql:
+        cur.execute(fts_sql["clientes_fts"], (fts_query(norm_term), limit))
+    else:
+        tokens = norm_term.split() or [""]
+        pats = [f"{tokens[0]}%"] + [f"%{t}%" for t in tokens[1:]]
+        params = [p for p in pats for _c in like_cols]
+        cur.execute(_build_like_sql(len(tokens)), (*params, limit))
+    # filas como tuplas: las claves salen una vez de cur.description ('' en vez de NULL, salvo el id)
+    keys = [d[0] for d in cur.description]
+    return tuple(
+        {k: v if k == "cliente_id" else (v or "") for k, v in zip(keys, row)}
+        for row in cur.fetchall()
+    )
 
 
 # ------------------------------ PANTALLA -----------------------------------
 
+def _fit_text_size(btn, *_):
+    """Un único handler compartido: el texto envuelve al ancho del botón."""
+    btn.text_size = (btn.width - dp(20), None)
+
+
 class TakeOrderScreen(Screen):
     current_user = StringProperty("")
 
@@ -138,6 +345,7 @@ class TakeOrderScreen(Screen):
 
         self.selected_client: Optional[Dict[str, Any]] = None
         self._last_items: List[Dict[str, Any]] = []
+        self._search_ev = None   # búsqueda pendiente (debounce)
 
         # cache para 'retomar'
         self._resume_cliente_rowid: Optional[int] = None
@@ -164,9 +372,32 @@ class TakeOrderScreen(Screen):
         # Lista de resultados
         self.sv = ScrollView(size_hint=(1, None), height=dp(360), do_scroll_x=False, do_scroll_y=True)
         self.grid = GridLayout(cols=1, size_hint_y=None, spacing=dp(6), padding=[0, 0, 0, dp(6)])
-        self.grid.bind(minimum_height=self.grid.setter("height"))
         self.sv.add_widget(self.grid)
 
+        # Pool fijo: la etiqueta "Sin resultados" + RESULTS_MAX botones, creados una sola vez.
+        # Cada búsqueda solo cambia texto/alto/opacidad; la altura de la grilla se fija a mano.
+        self._empty_lbl = Label(text="Sin resultados", size_hint_y=None, height=0,
+                                opacity=0, color=(1, 1, 1, 0.7))
+        self.grid.add_widget(self._empty_lbl)
+        self._btn_pool: List[Button] = []
+        for _ in range(RESULTS_MAX):
+            btn = Button(
+                size_hint_y=None,
+                height=0,
+                opacity=0,
+                disabled=True,
+                background_normal="",
+                background_color=(0.25, 0.25, 0.25, 1),
+                color=(1, 1, 1, 1),
+                halign="left",
+                valign="middle",
+            )
+            btn.text_size = (0, None)
+            btn.item = None
+            btn.bind(size=_fit_text_size, on_release=self._on_result_release)
+            self.grid.add_widget(btn)
+            self._btn_pool.append(btn)
+
         # --- Botón "Retomar orden" (KISS). Visible solo si hay borrador para el usuario ---
         self.resume_btn = Button(text="Retomar orden", size_hint=(1, None), height=0, disabled=True)
         self.resume_btn.bind(on_release=self._resume_order)
@@ -206,46 +437,57 @@ class TakeOrderScreen(Screen):
 
     # ---- Callbacks de UI ----
     def _on_search_text(self, *_):
+        if self._search_ev:
+            self._search_ev.cancel()
+            self._search_ev = None
         term = self.search_inp.text
         if len((term or "").strip()) < 2:
             self._populate_list([])
             return
-        items = search_clients(term, limit=30)
-        self._populate_list(items)
+        self._search_ev = Clock.schedule_once(lambda *_: self._do_search(term), SEARCH_DEBOUNCE_S)
 
-    def _populate_list(self, items: List[Dict[str, Any]]):
-        self._last_items = items[:]
-        self.grid.clear_widgets()
+    def _do_search(self, term: str):
+        self._search_ev = None
+        fut = _SEARCH_POOL.submit(search_clients, term, RESULTS_MAX)
+        # de vuelta al hilo de Kivy para tocar widgets
+        fut.add_done_callback(lambda f: Clock.schedule_once(lambda *_: self._on_search_done(term, f)))
 
-        if not items:
-            lbl = Label(text="Sin resultados", size_hint_y=None, height=dp(40), color=(1, 1, 1, 0.7))
-            self.grid.add_widget(lbl)
-            return
+    def _on_search_done(self, term: str, fut: Future):
+        if term != self.search_inp.text:
+            return  # resultado viejo: el usuario siguió escribiendo
+        self._populate_list(fut.result())
 
-        for it in items:
-            btn = Button(
-                text=f"{it['display']}\n{it['numero_identificacion_fiscal']}",
-                size_hint_y=None,
-                height=dp(48),
-                background_normal="",
-                background_color=(0.25, 0.25, 0.25, 1),
-                color=(1, 1, 1, 1),
-                halign="left",
-                valign="middle",
-            )
-            btn.text_size = (0, None)
-            btn.bind(size=lambda b, *_: setattr(b, "text_size", (b.width - dp(20), None)))
-
-            def _make_on_release(item: Dict[str, Any]):
-                def _handler(*_a):
-                    self.on_pick(item)
-                return _handler
-
-            btn.bind(on_release=_make_on_release(it))
-            self.grid.add_widget(btn)
+    def _populate_list(self, items: List[Dict[str, Any]]):
+        items = items[:RESULTS_MAX]
+        self._last_items = items[:]
+        grid = self.grid
+
+        empty = not items
+        self._empty_lbl.height = dp(40) if empty else 0
+        self._empty_lbl.opacity = 1 if empty else 0
+
+        for i, btn in enumerate(self._btn_pool):
+            if i < len(items):
+                it = items[i]
+                btn.item = it
+                btn.text = f"{it['display']}\n{it['numero_identificacion_fiscal']}"
+                btn.height, btn.opacity, btn.disabled = RESULT_H, 1, False
+            elif btn.item is not None:
+                btn.item = None
+                btn.text = ""
+                btn.height, btn.opacity, btn.disabled = 0, 0, True
+
+        # Alto solo de las filas usadas (etiqueta + items); los botones ocultos quedan al final, fuera de la vista
+        rows = 1 + len(items)
+        grid.height = (self._empty_lbl.height + RESULT_H * len(items)
+                       + grid.spacing[1] * (rows - 1) + grid.padding[1] + grid.padding[3])
 
         print("[UI] items mostrados:", len(items))
 
+    def _on_result_release(self, btn):
+        if btn.item is not None:
+            self.on_pick(btn.item)
+
     def on_pick(self, item: Dict[str, Any]):
         """Cuando se toca un resultado."""
         self.selected_client = item
@@ -286,23 +528,11 @@ class TakeOrderScreen(Screen):
             self.resume_btn.height = 0
             return
 
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.cursor()
-            cur.execute("""
-                SELECT cliente_rowid, payload_json
-                FROM order_drafts
-                WHERE user=?
-                ORDER BY id DESC
-                LIMIT 1
-            """, (self.current_user,))
-            row = cur.fetchone()
-        finally:
-            con.close()
-
-        if row:
-            self._resume_cliente_rowid = int(row[0] or 0)
-            self._resume_payload_json = row[1]
+        rowid, payload = _latest_draft(self.current_user)
+
+        if payload is not None:
+            self._resume_cliente_rowid = rowid
+            self._resume_payload_json = payload
             self.resume_btn.disabled = False
             self.resume_btn.height = dp(44)   # visible
         else:
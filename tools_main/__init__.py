@@ -0,0 +1,2 @@
+# Scripts de documentación (flujos Mermaid/draw.io, SQL, READMEs): se corren como
+# python3 tools_main/<script>.py o como python -m tools_main.<script>.
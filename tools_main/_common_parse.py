@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Lectura + ast.parse compartidos por generate_mermaid.py y analyze_sql.py.
+
+Memoizado en memoria por (ruta, mtime_ns, tamaño): si ambos corren en el mismo proceso
+(tools_main/docs_all.py) cada archivo se lee y se parsea una sola vez. Un archivo
+modificado cambia la clave, así que nunca se devuelve un árbol viejo.
+Los árboles son compartidos: los visitors solo leen, no los modifican.
+Los cachés no tienen tope (con uno fijo, en árboles grandes mermaid desalojaría cada
+archivo antes de que analyze_sql lo pida); quien los comparte llama clear() al terminar.
+"""
+from __future__ import annotations
+import ast
+import os
+from functools import lru_cache
+from typing import Tuple
+
+FileKey = Tuple[str, int, int]
+
+def file_key(path: "os.PathLike[str] | str") -> FileKey:
+    """(ruta, mtime_ns, tamaño) con un solo stat; clave de read_source/parse_source."""
+    st = os.stat(path)
+    return (os.fspath(path), st.st_mtime_ns, st.st_size)
+
+@lru_cache(maxsize=None)
+def read_source(key: FileKey) -> bytes:
+    with open(key[0], "rb") as fh:
+        return fh.read()
+
+@lru_cache(maxsize=None)
+def parse_source(key: FileKey) -> ast.Module:
+    """ast.parse sobre los bytes (respeta BOM y coding:); si no decodifican, se reintenta con
+    el texto UTF-8 ignorando lo inválido. SyntaxError/ValueError se propagan al llamador."""
+    src = read_source(key)
+    try:
+        return ast.parse(src, filename=key[0])
+    except (SyntaxError, ValueError):
+        return ast.parse(src.decode("utf-8", errors="ignore"), filename=key[0])
+
+def clear() -> None:
+    """Suelta los bytes y árboles memoizados (fin de docs_all.py)."""
+    read_source.cache_clear()
+    parse_source.cache_clear()
@@ -20,20 +20,37 @@ Uso:
 from __future__ import annotations
 import argparse
 import ast
+import hashlib
+import os
 import pathlib
+import pickle
 import re
-from typing import Iterable, List, Tuple, Dict, Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from operator import itemgetter
+from types import MappingProxyType
+from typing import Iterable, List, Mapping, Tuple, Dict, Optional, Set
+
+# como paquete (python -m tools_main.X) o como script (python3 tools_main/X.py)
+if __package__:
+    from ._common_parse import FileKey, file_key, parse_source, read_source
+else:
+    from _common_parse import FileKey, file_key, parse_source, read_source
 
 ROOT = pathlib.Path(__file__).resolve().parents[1]
 DOCS = ROOT / "docs"
 DOCS.mkdir(exist_ok=True)
+CACHE_DIR = ROOT / ".cache" / "analyze_sql"
+CACHE_VERSION = 2  # subir si cambia lo que devuelve extract_from_file
 
-IGNORE_DIRS = {
+# frozenset: solo se consulta (e.name in IGNORE_DIRS al podar el recorrido)
+IGNORE_DIRS = frozenset({
     ".venv","venv","__pycache__","build","dist",".buildozer","jni","external",
     ".git",".idea",".vscode","site-packages"
-}
+})
 
 SQL_RE = re.compile(r"(?is)\b(SELECT|INSERT|UPDATE|DELETE)\b")
+SQL_RE_B = re.compile(rb"(?is)\b(SELECT|INSERT|UPDATE|DELETE)\b")  # mismo filtro, sobre bytes crudos
 # capturas simples (heurísticas útiles y robustas para nuestra doc)
 RE_SELECT_FIELDS = re.compile(r"(?is)\bSELECT\b(.*?)\bFROM\b")
 RE_FROM_TABLES   = re.compile(r"(?is)\bFROM\b\s+([A-Za-z0-9_]+)")
@@ -42,13 +59,39 @@ RE_INSERT_TABLE  = re.compile(r"(?is)\bINSERT\s+INTO\b\s+([A-Za-z0-9_]+)")
 RE_UPDATE_TABLE  = re.compile(r"(?is)\bUPDATE\b\s+([A-Za-z0-9_]+)")
 RE_DELETE_TABLE  = re.compile(r"(?is)\bDELETE\s+FROM\b\s+([A-Za-z0-9_]+)")
 RE_WHERE         = re.compile(r"(?is)\bWHERE\b(.*?)(?:\bGROUP\b|\bORDER\b|\bLIMIT\b|$)")
-RE_ORDER_BY      = re.compile(r"(?is)\bORDER\s+BY\b")
-RE_LIMIT         = re.compile(r"(?is)\bLIMIT\b")
+# WHERE / ORDER BY / LIMIT en una sola pasada
+RE_CLAUSES       = re.compile(r"(?is)\b(?:(WHERE)|(ORDER\s+BY)|(LIMIT))\b")
+
+# palabra clave -> (tipo, regex de tablas a aplicar)
+_KINDS: Dict[str, Tuple[str, Tuple[re.Pattern, ...]]] = {
+    "SELECT": ("Lectura (SELECT)",       (RE_FROM_TABLES, RE_JOIN_TABLES)),
+    "INSERT": ("Escritura (INSERT)",     (RE_INSERT_TABLE,)),
+    "UPDATE": ("Actualización (UPDATE)", (RE_UPDATE_TABLE,)),
+    "DELETE": ("Eliminación (DELETE)",   (RE_DELETE_TABLE,)),
+}
+# normalización de texto (compiladas una vez; se usan por cada consulta / archivo)
+_WS_RE   = re.compile(r"\s+")
+_SYM_RE  = re.compile(r"[^\w\s-]")
+_DASH_RE = re.compile(r"-+")
 
 
 def _should_ignore(path: pathlib.Path) -> bool:
     return any(seg in IGNORE_DIRS for seg in path.parts)
 
+def _walk_py(root: str, recurse: bool = True) -> Iterable[pathlib.Path]:
+    """.py bajo root vía os.scandir; no entra a IGNORE_DIRS (ni hace stat de su contenido)."""
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            if recurse and e.name not in IGNORE_DIRS:
+                yield from _walk_py(e.path, recurse)
+        elif e.name.endswith(".py"):
+            yield pathlib.Path(e.path)
+
 def iter_py_files(paths: Iterable[str], files: Iterable[str], no_recurse: bool) -> Iterable[pathlib.Path]:
     seen: set[pathlib.Path] = set()
 
@@ -67,15 +110,17 @@ def iter_py_files(paths: Iterable[str], files: Iterable[str], no_recurse: bool)
     for d in paths:
         base = (ROOT / d).resolve()
         if not base.exists(): continue
-        it = base.glob("*.py") if no_recurse else base.rglob("*.py")
-        for p in it:
-            if add(p): yield p
+        for p in _walk_py(str(base), not no_recurse):
+            if p not in seen:
+                seen.add(p); yield p
 
     # default: whole repo
     if not paths and not files:
-        for p in ROOT.rglob("*.py"):
-            if add(p): yield p
+        for p in _walk_py(str(ROOT)):
+            if p not in seen:
+                seen.add(p); yield p
 
+@lru_cache(maxsize=None)
 def _clean_sql_for_block(sql: str) -> str:
     """Normaliza espacios y sangrías, pero sin reescribir SQL."""
     s = sql.strip("\n")
@@ -83,150 +128,176 @@ def _clean_sql_for_block(sql: str) -> str:
     return s
 
 def _split_fields(fields_blob: str) -> List[str]:
-    raw = [x.strip() for x in fields_blob.split(",")]
-    return [re.sub(r"\s+", " ", f) for f in raw if f]
+    return [_WS_RE.sub(" ", f) for f in (x.strip() for x in fields_blob.split(",")) if f]
 
-def classify_and_summarize(sql: str) -> Dict[str, object]:
+@lru_cache(maxsize=None)
+def classify_and_summarize(sql: str) -> Mapping[str, object]:
     """
-    Devuelve:
+    Memoizada por texto SQL (la misma consulta suele repetirse en varios execute()).
+    Devuelve un mapping de solo lectura:
       {
         "type": "Lectura (SELECT)" | "Escritura (INSERT)" | "Actualización (UPDATE)" | "Eliminación (DELETE)",
-        "tables": ["t1","t2",...],
-        "fields": ["f1","f2",...],
+        "tables": ("t1","t2",...),
+        "fields": ("f1","f2",...),
         "where": "condición ..." | None,
         "has_order": bool,
         "has_limit": bool,
       }
     """
     kind = None
-    m = SQL_RE.search(sql)
-    if m:
-        kw = m.group(1).upper()
-        if kw == "SELECT": kind = "Lectura (SELECT)"
-        elif kw == "INSERT": kind = "Escritura (INSERT)"
-        elif kw == "UPDATE": kind = "Actualización (UPDATE)"
-        elif kw == "DELETE": kind = "Eliminación (DELETE)"
-
     tables: List[str] = []
     fields: List[str] = []
     where: Optional[str] = None
 
-    if kind and "SELECT" in kind:
-        mf = RE_SELECT_FIELDS.search(sql)
-        if mf:
-            fields = _split_fields(mf.group(1))
-        t = RE_FROM_TABLES.findall(sql)
-        j = RE_JOIN_TABLES.findall(sql)
-        tables = [*t, *j]
-    elif kind and "INSERT" in kind:
-        tables = RE_INSERT_TABLE.findall(sql)
-    elif kind and "UPDATE" in kind:
-        tables = RE_UPDATE_TABLE.findall(sql)
-    elif kind and "DELETE" in kind:
-        tables = RE_DELETE_TABLE.findall(sql)
-
-    mw = RE_WHERE.search(sql)
-    if mw:
-        where = re.sub(r"\s+", " ", mw.group(1).strip())
-
-    has_order = bool(RE_ORDER_BY.search(sql))
-    has_limit = bool(RE_LIMIT.search(sql))
-
-    return {
+    m = SQL_RE.search(sql)
+    if m:
+        kw = m.group(1).upper()
+        kind, table_res = _KINDS[kw]
+        if kw == "SELECT":
+            mf = RE_SELECT_FIELDS.search(sql)
+            if mf:
+                fields = _split_fields(mf.group(1))
+        for rx in table_res:
+            tables.extend(rx.findall(sql))
+
+    has_order = has_limit = False
+    for mc in RE_CLAUSES.finditer(sql):
+        if mc.group(1):
+            if where is None:
+                mw = RE_WHERE.match(sql, mc.start())
+                where = _WS_RE.sub(" ", mw.group(1).strip()) if mw else None
+        elif mc.group(2):
+            has_order = True
+        else:
+            has_limit = True
+
+    return MappingProxyType({
         "type": kind or "Consulta SQL",
-        "tables": tables,
-        "fields": fields,
+        "tables": tuple(tables),
+        "fields": tuple(fields),
         "where": where,
         "has_order": has_order,
         "has_limit": has_limit,
-    }
+    })
 
 # ---------- AST-based extraction ----------
 
-class SQLCollector(ast.NodeVisitor):
-    """Recoge (sql_text, lineno) encontrados en un módulo."""
-    def __init__(self, source: str):
-        self.source = source
-        self.const_map: Dict[str, str] = {}   # nombre -> sql string
-        self.results: List[Tuple[str, int]] = []
-
-    # helpers para obtener string de nodos
-    def _const_str(self, node: ast.AST) -> Optional[str]:
-        if isinstance(node, ast.Constant) and isinstance(node.value, str):
-            return node.value
-        if isinstance(node, ast.JoinedStr):
-            # f-strings: concatenamos las partes literales y dejamos {expr} como ?
-            parts = []
-            for v in node.values:
-                if isinstance(v, ast.FormattedValue):
-                    parts.append("?")
-                elif isinstance(v, ast.Constant) and isinstance(v.value, str):
-                    parts.append(v.value)
-            return "".join(parts)
-        return None
-
-    def _maybe_record(self, s: Optional[str], lineno: int):
-        if not s: return
-        if SQL_RE.search(s):
-            self.results.append((s, lineno))
-
-    # visit
-    def visit_Assign(self, node: ast.Assign):
-        # constantes con SQL: SQL_SELECT = "SELECT ..."
-        s = self._const_str(node.value)
-        if s and SQL_RE.search(s):
-            for t in node.targets:
-                if isinstance(t, ast.Name):
-                    self.const_map[t.id] = s
-        self.generic_visit(node)
-
-    def visit_Call(self, node: ast.Call):
-        # cursor.execute("SELECT ...") o execute(SQL_SELECT)
-        if node.args:
-            s = self._const_str(node.args[0])
-            if s is None and isinstance(node.args[0], ast.Name):
-                s = self.const_map.get(node.args[0].id)
-            self._maybe_record(s, getattr(node, "lineno", 1))
-        # keyword args (ej. query=...)
-        for kw in node.keywords or []:
-            s = self._const_str(kw.value)
-            if s is None and isinstance(kw.value, ast.Name):
-                s = self.const_map.get(kw.value.id)
-            self._maybe_record(s, getattr(node, "lineno", 1))
-        self.generic_visit(node)
-
-    def visit_Constant(self, node: ast.Constant):
-        # fallback: cualquier string literal con SQL
-        if isinstance(node.value, str) and SQL_RE.search(node.value):
-            self.results.append((node.value, getattr(node, "lineno", 1)))
-        # no generic_visit para constants
-
-def extract_from_file(path: pathlib.Path) -> List[Tuple[str, int]]:
-    src = path.read_text(encoding="utf-8", errors="ignore")
-    try:
-        tree = ast.parse(src)
-    except SyntaxError:
+@lru_cache(maxsize=4096)
+def _has_sql(s: str) -> bool:
+    """SQL_RE.search memoizado: el mismo literal se evalúa en el Assign/Call y de nuevo como Constant."""
+    return SQL_RE.search(s) is not None
+
+def _const_str(node: ast.AST) -> Optional[str]:
+    """String de un nodo: literal, o f-string con sus partes literales y {expr} como ?."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        parts = []
+        for v in node.values:
+            if isinstance(v, ast.FormattedValue):
+                parts.append("?")
+            elif isinstance(v, ast.Constant) and isinstance(v.value, str):
+                parts.append(v.value)
+        return "".join(parts)
+    return None
+
+def collect_sql(tree: ast.AST) -> List[Tuple[str, int]]:
+    """
+    Recoge (sql_text, lineno) de un módulo en un DFS iterativo (pila explícita y despacho
+    por type(), sin NodeVisitor). Mismo orden de visita que antes:
+      - NOMBRE = "<sql>"                      -> constante (para execute(NOMBRE))
+      - execute("<sql>") / execute(NOMBRE) / kw=...
+      - cualquier string literal con SQL (fallback; recoge también las partes de f-strings
+        y SQL suelto que no pasa por execute, por eso se mantiene)
+    Un mismo (sql, línea) se registra una sola vez: execute("<sql>") en una línea lo
+    capturaría la llamada y luego otra vez el literal.
+    """
+    const_map: Dict[str, str] = {}   # nombre -> sql string
+    results: List[Tuple[str, int]] = []
+    seen: Set[Tuple[str, int]] = set()
+    stack: List[ast.AST] = [tree]
+    while stack:
+        node = stack.pop()
+        t = type(node)
+        if t is ast.Constant:
+            if isinstance(node.value, str) and _has_sql(node.value):  # type: ignore[attr-defined]
+                key = (node.value, getattr(node, "lineno", 1))  # type: ignore[attr-defined]
+                if key not in seen:
+                    seen.add(key); results.append(key)
+            continue  # no se baja en constants
+        if t is ast.Assign:
+            s = _const_str(node.value)  # type: ignore[attr-defined]
+            if s and _has_sql(s):
+                for tg in node.targets:  # type: ignore[attr-defined]
+                    if isinstance(tg, ast.Name):
+                        const_map[tg.id] = s
+        elif t is ast.Call:
+            lineno = getattr(node, "lineno", 1)
+            cands = node.args[:1] + [kw.value for kw in node.keywords or []]  # type: ignore[attr-defined]
+            for arg in cands:
+                s = _const_str(arg)
+                if s is None and isinstance(arg, ast.Name):
+                    s = const_map.get(arg.id)
+                if s and _has_sql(s) and (s, lineno) not in seen:
+                    seen.add((s, lineno)); results.append((s, lineno))
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+    return results
+
+def extract_from_file(path: pathlib.Path, key: Optional[FileKey] = None) -> List[Tuple[str, int]]:
+    key = key or file_key(path)  # _cached_extract ya lo trae: sin segundo stat
+    # sin ninguna palabra SQL en el texto no hay nada que recoger: se evita ast.parse
+    if not SQL_RE_B.search(read_source(key)):
+        return []
+    try:  # árbol compartido con generate_mermaid si corren en el mismo proceso
+        tree = parse_source(key)
+    except (SyntaxError, ValueError):
         return []
-    col = SQLCollector(src)
-    col.visit(tree)
-    return col.results
+    return collect_sql(tree)
+
+def _cached_extract(path: pathlib.Path, use_cache: bool = True) -> List[Tuple[str, int]]:
+    """extract_from_file con caché en disco: .cache/analyze_sql/<hash(ruta, mtime, tamaño)>.pkl."""
+    if not use_cache:
+        return extract_from_file(path)
+    fkey = file_key(path)
+    key = hashlib.blake2b(f"{CACHE_VERSION}:{path}:{fkey[1]}:{fkey[2]}".encode(), digest_size=16).hexdigest()
+    cpath = CACHE_DIR / f"{key}.pkl"
+    try:
+        with open(cpath, "rb") as fh:
+            return pickle.load(fh)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    result = extract_from_file(path, fkey)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # escritura atómica: otra corrida (o un Ctrl-C) no deja un .pkl a medias en el caché
+    tmp = cpath.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    os.replace(tmp, cpath)
+    return result
+
+def _extract_all(files: List[pathlib.Path], use_cache: bool = True) -> List[List[Tuple[str, int]]]:
+    """extract_from_file por archivo; en procesos si hay varios (ast.parse es CPU puro)."""
+    extract = partial(_cached_extract, use_cache=use_cache)
+    if len(files) < 4:
+        return [extract(p) for p in files]
+    with ProcessPoolExecutor() as ex:
+        return list(ex.map(extract, files, chunksize=16))
 
 # ---------- Rendering agrupado ----------
 
 def _slugify(s: str) -> str:
     """Slug simple para anchors GitHub-like."""
     s = s.lower()
-    s = re.sub(r"[^\w\s-]", "", s)   # quita símbolos (.,",etc.)
-    s = re.sub(r"\s+", "-", s.strip())
-    s = re.sub(r"-+", "-", s)
+    s = _SYM_RE.sub("", s)   # quita símbolos (.,",etc.)
+    s = _WS_RE.sub("-", s.strip())
+    s = _DASH_RE.sub("-", s)
     return s
 
-def render_entry_block(lineno: int, sql: str) -> str:
-    """Bloque de una consulta (misma forma de hoy), sin repetir cabecera de archivo."""
-    sql_block = _clean_sql_for_block(sql)
+def render_entry_block(lineno: int, sql_block: str, lines: List[str]) -> None:
+    """Bloque de una consulta (misma forma de hoy), sin repetir cabecera de archivo.
+    'sql_block' ya viene limpio (_clean_sql_for_block se aplica al deduplicar en main).
+    Agrega las líneas a 'lines' (la lista única del documento)."""
     info = classify_and_summarize(sql_block)
 
-    lines: List[str] = []
     lines.append(f"**Línea {lineno}**")
     lines.append("")
     lines.append("```sql")
@@ -251,13 +322,10 @@ def render_entry_block(lineno: int, sql: str) -> str:
     if info["has_limit"]:
         lines.append(f"- Limita cantidad de filas con **LIMIT**.")
 
-    return "\n".join(lines)
-
-def render_file_section(relpath: pathlib.Path, entries: List[Tuple[int, str]]) -> str:
-    """Sección completa para un archivo con sus consultas."""
+def render_file_section(relpath: pathlib.Path, entries: List[Tuple[int, str]], lines: List[str]) -> None:
+    """Sección completa para un archivo con sus consultas (agregada a 'lines')."""
     fname = relpath.as_posix()
     anchor = _slugify(fname)  # para el índice
-    lines: List[str] = []
     lines.append("------------------------------------------------------------------------")
     lines.append(f'## Archivo: "{fname}"')
     lines.append(f'<a id="{anchor}"></a>')
@@ -267,9 +335,8 @@ def render_file_section(relpath: pathlib.Path, entries: List[Tuple[int, str]]) -
             lines.append("")         # respiro
             lines.append("---")      # separador suave entre consultas
             lines.append("")
-        lines.append(render_entry_block(ln, sql))
+        render_entry_block(ln, sql, lines)
     lines.append("")  # cierre
-    return "\n".join(lines)
 
 # ---------- Main ----------
 
@@ -279,17 +346,18 @@ def main():
     ap.add_argument("--files", nargs="*", default=[], help="Archivos .py específicos")
     ap.add_argument("--no_recurse", action="store_true", help="No descender a subdirectorios")
     ap.add_argument("--outfile", default=str(DOCS / "sql_insights.md"))
+    ap.add_argument("--no-cache", action="store_true", help="No usar el caché de extracción (.cache/analyze_sql)")
     args = ap.parse_args()
 
-    # Mapa: archivo_rel -> set de (lineno, sql) para deduplicar
+    # Mapa: archivo_rel -> (lineno, sql) deduplicados. dict y no set: conserva el orden
+    # de aparición de varias consultas en una misma línea (el sort por línea es estable)
     per_file: Dict[pathlib.Path, Dict[Tuple[int, str], None]] = {}
 
-    for p in iter_py_files(args.paths, args.files, args.no_recurse):
+    files = list(iter_py_files(args.paths, args.files, args.no_recurse))
+    for p, found in zip(files, _extract_all(files, not args.no_cache)):
         rel = p.relative_to(ROOT)
-        bucket = per_file.setdefault(rel, {})
-        for sql, ln in extract_from_file(p):
-            sql_block = _clean_sql_for_block(sql)
-            bucket[(ln, sql_block)] = None  # dedup exacto por (línea, sql)
+        # dedup exacto por (línea, sql), insertado en bloque
+        per_file.setdefault(rel, {}).update(dict.fromkeys((ln, _clean_sql_for_block(sql)) for sql, ln in found))
 
     out = pathlib.Path(args.outfile)
     out.parent.mkdir(parents=True, exist_ok=True)
@@ -303,7 +371,7 @@ def main():
 
     if not per_file:
         content = "\n".join(header + ["*(no se detectaron consultas)*"])
-        out.write_text(content, encoding="utf-8")
+        out.write_bytes(content.encode("utf-8"))
         print(f"OK ➜ {out}")
         return
 
@@ -319,14 +387,14 @@ def main():
     index_lines.append("---")
     index_lines.append("")
 
-    # Secciones por archivo
-    body_sections: List[str] = []
+    # Secciones por archivo: todas escriben en una sola lista y se une una vez
+    body: List[str] = []
     for rel in files_sorted:
-        entries_sorted = sorted(per_file[rel].keys(), key=lambda x: x[0])  # por línea
-        body_sections.append(render_file_section(rel, entries_sorted))
+        entries_sorted = sorted(per_file[rel], key=itemgetter(0))  # por línea
+        render_file_section(rel, entries_sorted, body)
 
-    content = "\n".join(header + index_lines + body_sections)
-    out.write_text(content, encoding="utf-8")
+    content = "\n".join(header + index_lines + body)
+    out.write_bytes(content.encode("utf-8"))
     print(f"OK ➜ {out}")
 
 if __name__ == "__main__":
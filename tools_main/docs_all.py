@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Corre generate_mermaid.py y analyze_sql.py en un mismo proceso: cada archivo se lee y se
+parsea una sola vez (_common_parse) en vez de una vez por script.
+
+Uso:
+  # Todo el repo -> docs/flow.md y docs/sql_insights.md
+  python3 tools_main/docs_all.py
+
+  # Solo archivos indicados; el resto de flags va a generate_mermaid
+  python3 tools_main/docs_all.py --files historial.py carrito.py --include_db --label_edges
+
+Mermaid se parsea en este proceso (--jobs 1) para que los árboles queden en memoria;
+analyze_sql los reusa (en secuencial, o en sus workers hechos con fork, que heredan la memoria).
+"""
+from __future__ import annotations
+import argparse
+import sys
+from typing import Callable, List
+
+# como paquete (python -m tools_main.docs_all) o como script (python3 tools_main/docs_all.py)
+if __package__:
+    from . import _common_parse, analyze_sql, generate_mermaid
+else:
+    import _common_parse
+    import analyze_sql
+    import generate_mermaid
+
+def _run(main: Callable[[], None], prog: str, argv: List[str]) -> None:
+    """main() de un script con su propio sys.argv."""
+    saved = sys.argv
+    sys.argv = [prog, *argv]
+    try:
+        main()
+    finally:
+        sys.argv = saved
+
+def main():
+    ap = argparse.ArgumentParser(description="Genera docs/flow.md y docs/sql_insights.md con un solo parseo por archivo")
+    ap.add_argument("--paths", nargs="*", default=[])
+    ap.add_argument("--files", nargs="*", default=[])
+    ap.add_argument("--no_recurse", action="store_true")
+    ap.add_argument("--no-cache", action="store_true", help="No usar los cachés en disco de cada script")
+    args, mermaid_args = ap.parse_known_args()
+
+    common: List[str] = []
+    if args.paths: common += ["--paths", *args.paths]
+    if args.files: common += ["--files", *args.files]
+    if args.no_recurse: common.append("--no_recurse")
+    if args.no_cache: common.append("--no-cache")
+
+    if "--jobs" not in mermaid_args:
+        mermaid_args = ["--jobs", "1", *mermaid_args]
+    try:
+        _run(generate_mermaid.main, "generate_mermaid.py", common + mermaid_args)
+        _run(analyze_sql.main, "analyze_sql.py", common)
+    finally:
+        _common_parse.clear()  # los cachés no tienen tope: se sueltan al terminar
+
+if __name__ == "__main__":
+    main()
@@ -23,8 +23,12 @@ from __future__ import annotations
 from collections import defaultdict
 
 
-import argparse, ast, html, math, pathlib, re, time
-from collections import defaultdict, deque
+import argparse, ast, hashlib, math, os, pathlib, pickle, re, time
+from sys import intern
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain
 from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from collections.abc import Sequence
@@ -35,14 +39,37 @@ from typing import Optional
 ROOT = pathlib.Path(__file__).resolve().parents[1]
 DOCS = ROOT / "docs"
 DOCS.mkdir(exist_ok=True)
-IGNORE_DIRS = {
+CACHE_DIR = ROOT / ".cache" / "generate_drawio"
+CACHE_VERSION = 5  # subir si cambia lo que devuelve _parse_file
+# frozenset: solo se consulta (e.name in IGNORE_DIRS al podar el recorrido)
+IGNORE_DIRS = frozenset({
     ".venv","venv","__pycache__","build","dist",".buildozer","jni","external",
     ".git",".idea",".vscode"
-}
+})
 
 # ---------------- Detección SQL/DB ----------------
-SQL_RE = re.compile(r"(?is)\b(SELECT|INSERT|UPDATE|DELETE)\b")
-DB_NAME_RE = re.compile(r'(?i)([A-Za-z0-9_\-./]+?\.(?:db|sqlite3?|sqlite))')
+# verbo SQL o nombre de DB en una sola pasada (alternativa con grupos nombrados)
+TOKEN_RE = re.compile(r"(?is)\b(?P<sql>SELECT|INSERT|UPDATE|DELETE)\b"
+                      r"|(?P<db>[A-Za-z0-9_\-./]+?\.(?:db|sqlite3?|sqlite))")
+_SQL_VERBS = ("select", "insert", "update", "delete")
+
+@lru_cache(maxsize=8192)
+def _scan_sql_db(s: str) -> Tuple[Optional[str], Optional[str]]:
+    """(verbo SQL en mayúsculas, nombre de DB) de un literal; un mismo string se escanea una vez.
+    Gana la primera coincidencia de cada tipo."""
+    # descarte barato: la mayoría de los literales no tienen ni verbo ni "."
+    if "." not in s:
+        sl = s.lower()
+        if not any(k in sl for k in _SQL_VERBS):
+            return None, None
+    sql = db = None
+    for m in TOKEN_RE.finditer(s):
+        if m.lastgroup == "sql":
+            if sql is None: sql = m.group("sql").upper()
+        elif db is None:
+            db = m.group("db")
+        if sql and db: break
+    return sql, db
 
 # ---------------- Estilos draw.io ----------------
 def style_palette(theme: str) -> Dict[str, str]:
@@ -82,196 +109,233 @@ def drawio_edge_style(edge_style: str, arrow: str, color: str, dashed: bool, lin
     return f"endArrow={end_arrow};rounded=1;jettySize=auto;{es}{jumps}{dash}strokeColor={color};{dash}"
 
 # ---------------- Constantes SQL/DB ----------------
-class ConstCollector(ast.NodeVisitor):
-    """Recoge constantes tipo:
+def _extract_path_str(node: ast.AST) -> Optional[str]:
+    """"x.db" de Path("x.db") / pathlib.Path("x.db"); None si no es eso."""
+    if not isinstance(node, ast.Call):
+        return None
+    fn = None
+    if isinstance(node.func, ast.Name):
+        fn = node.func.id
+    elif isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
+        fn = f"{node.func.value.id}.{node.func.attr}"
+    if fn not in {"Path", "pathlib.Path"}:
+        return None
+    if node.args and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+        return node.args[0].value
+    return None
+
+# ---------------- Visitor principal ----------------
+# Nodos hoja para V: no pueden contener ClassDef/FunctionDef/Call/Import/Assign, no se apilan
+# (p. ej. el literal SQL o el nombre pasado a execute(), ya leídos por _label_from_args)
+_LEAF_TYPES = frozenset({ast.Constant, ast.Name, ast.Load, ast.Store, ast.Del, ast.alias,
+                         ast.Pass, ast.Break, ast.Continue, ast.Global, ast.Nonlocal})
+
+class V:
+    """Una sola pasada por el AST (DFS iterativo, pila explícita, tabla type -> handler) que junta
+    imports, constantes SQL/DB y llamadas. Constantes reconocidas:
         SQL_TX = "select ..."
         DB_PATH = "bd_sqlite/x.db"
         DB_PATH = Path("bd_sqlite/x.db")    # pathlib / from pathlib import Path
-    """
-    def __init__(self):
-        self.sql_of: Dict[str,str] = {}
-        self.db_of:  Dict[str,str] = {}
-
-    def _extract_path_str(self, node: ast.AST) -> Optional[str]:
-        if not isinstance(node, ast.Call):
-            return None
-        fn = None
-        if isinstance(node.func, ast.Name):
-            fn = node.func.id
-        elif isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
-            fn = f"{node.func.value.id}.{node.func.attr}"
-        if fn not in {"Path", "pathlib.Path"}:
-            return None
-        if node.args and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
-            return node.args[0].value
-        return None
+    El contexto de clase de cada llamada se fija durante el recorrido; lo que depende de imports y
+    constantes se resuelve al terminar, con todo el módulo visto (igual que con pasadas separadas)."""
+    # marcas de la pila: visitar nodo / salir de clase / salir de función
+    _VISIT, _END_CLASS, _END_FUNC = range(3)
+
+    def __init__(self, mod: str):
+        self.mod = mod
+        self.mod_root = mod.split(".", 1)[0]
+        self.iroot: Dict[str,str] = {}  # alias importado -> paquete raíz (split una vez por import)
+        self.csql: Dict[str,str] = {}   # nombre -> verbo SQL
+        self.cdb: Dict[str,str]  = {}   # nombre -> archivo .db
+        self._calls: List[Tuple[ast.Call, str, Optional[str]]] = []  # (Call, caller, destino por clase)
+        self.class_stack: List[str] = []
+        self.stack: List[str] = []
+        self.funcs: Dict[str, str] = {}   # nombre calificado -> nombre corto (sin re-split después)
+        self.func_class_of: Dict[str, Optional[str]] = {}
+        self.edges: Set[Tuple[str,str]] = set()  # (u, "tgt_mod.tgt_fn" ya armado); sin label: no se dibuja
+        self.databases: Set[str] = set()
+        self.db_edges: Set[Tuple[str,str,Optional[str]]] = set()   # (u, db, SQL), sin repetidos
+        self.methods_by_class: Dict[str, Set[str]] = defaultdict(set)  # <- NUEVO
+
+
+    def cur(self): return self.stack[-1] if self.stack else None
+    def _qual(self, fn: str) -> str:
+        # internados: funcs, edges y db_edges comparten el mismo objeto por nombre
+        # (comparaciones por identidad en los sets y un solo string por nombre al picklear)
+        if self.class_stack: return intern(f"{self.mod}.{self.class_stack[-1]}.{fn}")
+        return intern(f"{self.mod}.{fn}")
+
+    def visit(self, tree: ast.AST):
+        work: List[Tuple[int, object]] = [(self._VISIT, tree)]
+        dispatch = self._DISPATCH
+        while work:
+            op, node = work.pop()
+            if op == self._END_CLASS:
+                self.class_stack.pop(); continue
+            if op == self._END_FUNC:
+                self.stack.pop(); continue
+            handler = dispatch.get(type(node))
+            if handler is None:
+                self._push_children(work, node)  # type: ignore[arg-type]
+            else:
+                handler(self, node, work)
+
+        # en el orden original: self.databases crece igual que al procesarlas en el recorrido
+        for node, caller, cls_mod in self._calls:
+            cm, cf = self._resolve_call(node.func)
+            self._process_call(node, caller, cls_mod or cm, cf)
+        self._calls.clear()
+
+    # ---- despacho por tipo: type(node) -> handler, tabla armada una vez en la clase ----
+    def _push_children(self, work: List[Tuple[int, object]], n: ast.AST):
+        # en orden inverso: el primer hijo sale primero (mismo orden que generic_visit)
+        work.extend((self._VISIT, c) for c in reversed(list(ast.iter_child_nodes(n)))
+                    if type(c) not in _LEAF_TYPES)
+
+    def _on_class(self, node: ast.ClassDef, work: List[Tuple[int, object]]):
+        self.class_stack.append(node.name)
+        work.append((self._END_CLASS, None)); self._push_children(work, node)
 
-    def visit_Assign(self, node: ast.Assign):
+    def _on_function(self, node: ast.FunctionDef, work: List[Tuple[int, object]]):
+        self._enter_function(node)
+        work.append((self._END_FUNC, None)); self._push_children(work, node)
+
+    def _on_call(self, node: ast.Call, work: List[Tuple[int, object]]):
+        caller = self.cur()
+        if not caller:
+            return
+        # methods_by_class/class_stack cambian durante el recorrido: se leen ahora
+        self._calls.append((node, caller, self._class_target(node)))
+        self._push_children(work, node)
+
+    def _on_import(self, node: ast.AST, work: List[Tuple[int, object]]):
+        self._collect_import(node)
+
+    def _on_assign(self, node: ast.Assign, work: List[Tuple[int, object]]):
+        self._collect_const(node)
+        self._push_children(work, node)
+
+    _DISPATCH = {ast.ClassDef: _on_class, ast.FunctionDef: _on_function, ast.AsyncFunctionDef: _on_function,
+                 ast.Call: _on_call, ast.Import: _on_import, ast.ImportFrom: _on_import, ast.Assign: _on_assign}
+
+    # ---- imports / constantes ----
+    # se recogen en el mismo recorrido que las llamadas, también dentro de funciones (imports
+    # perezosos): los mapas son de todo el módulo y no hay pasada aparte que recortar
+    def _collect_import(self, node: ast.AST):
+        if type(node) is ast.Import:
+            for alias in node.names:  # type: ignore[attr-defined]
+                mod = alias.name
+                self.iroot[alias.asname or mod.split(".")[-1]] = mod.split(".", 1)[0]
+            return
+        if node.module is None: return  # type: ignore[attr-defined]
+        root = node.module.split(".", 1)[0]  # type: ignore[attr-defined]
+        for alias in node.names:  # type: ignore[attr-defined]
+            self.iroot[alias.asname or alias.name] = root
+
+    def _collect_const(self, node: ast.Assign):
         s_val: Optional[str] = None
 
         if isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
             s_val = node.value.value
         elif isinstance(node.value, ast.Call):
-            ps = self._extract_path_str(node.value)
+            ps = _extract_path_str(node.value)
             if ps:
                 s_val = ps
 
         if s_val is None:
             return
 
-        m  = SQL_RE.search(s_val)
-        m2 = DB_NAME_RE.search(s_val)
-        sql = m.group(1).upper() if m else None
-        db  = m2.group(1) if m2 else None
+        sql, db = _scan_sql_db(s_val)
         if not sql and not db:
             return
 
         for t in node.targets:
             if isinstance(t, ast.Name):
-                if sql: self.sql_of[t.id] = sql
-                if db:  self.db_of[t.id]  = db
-
-# ---------------- Imports ----------------
-class ImportResolver(ast.NodeVisitor):
-    def __init__(self):
-        self.name_to_module: Dict[str,str] = {}
-    def visit_Import(self, node: ast.Import):
-        for alias in node.names:
-            mod = alias.name
-            asname = alias.asname or mod.split(".")[-1]
-            self.name_to_module[asname] = mod
-    def visit_ImportFrom(self, node: ast.ImportFrom):
-        if node.module is None: return
-        base = node.module
-        for alias in node.names:
-            local = alias.asname or alias.name
-            self.name_to_module[local] = base
-
-# ---------------- Visitor principal ----------------
-class V(ast.NodeVisitor):
-    def __init__(self, mod: str, src: str, imap: Dict[str,str], csql: Dict[str,str], cdb: Dict[str,str]):
-        self.mod = mod
-        self.src = src
-        self.imap = imap
-        self.csql = csql
-        self.cdb  = cdb
-        self.class_stack: List[str] = []
-        self.stack: List[str] = []
-        self.funcs: Set[str] = set()
-        self.func_class_of: Dict[str, Optional[str]] = {}
-        self.edges: Set[Tuple[str,str,str,Optional[str]]] = set()  # (u, tgt_mod, tgt_fn, label)
-        self.databases: Set[str] = set()
-        self.db_edges: List[Tuple[str,str,Optional[str]]] = []     # (u, db, SQL)
-        self.methods_by_class: Dict[str, Set[str]] = defaultdict(set)  # <- NUEVO
-
-
-    def cur(self): return self.stack[-1] if self.stack else None
-    def _qual(self, fn: str) -> str:
-        if self.class_stack: return f"{self.mod}.{self.class_stack[-1]}.{fn}"
-        return f"{self.mod}.{fn}"
-
-    def visit_ClassDef(self, n: ast.ClassDef):
-        self.class_stack.append(n.name); self.generic_visit(n); self.class_stack.pop()
+                if sql: self.csql[t.id] = sql
+                if db:  self.cdb[t.id]  = db
 
-    def visit_FunctionDef(self, n: ast.FunctionDef):
+    def _enter_function(self, n: ast.FunctionDef):
         fn = self._qual(n.name)
-        self.funcs.add(fn)
+        self.funcs[fn] = n.name
         # guarda mapeo función->clase (ya estaba)
         self.func_class_of[fn] = self.class_stack[-1] if self.class_stack else None
         # registra que este nombre de método existe en la clase actual
         if self.class_stack:
             self.methods_by_class[self.class_stack[-1]].add(n.name)   # <- NUEVO
         self.stack.append(fn)
-        self.generic_visit(n)
-        self.stack.pop()
-
-    def visit_AsyncFunctionDef(self, n: ast.AsyncFunctionDef): self.visit_FunctionDef(n) # type: ignore
 
     def _resolve_call(self, node: ast.AST) -> Tuple[str,str]:
-        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+        if type(node) is ast.Attribute and type(node.value) is ast.Name:
             base=node.value.id; fn=node.attr
-            if base in self.imap: return (self.imap[base].split(".")[0], fn)
+            if base in self.iroot: return (self.iroot[base], fn)
             return (self.mod, fn)
-        if isinstance(node, ast.Name):
+        if type(node) is ast.Name:
             name=node.id
-            if name in self.imap: return (self.imap[name].split(".")[0], name)
+            if name in self.iroot: return (self.iroot[name], name)
             return (self.mod, name)
         return (self.mod, "<call>")
 
-    def _label_from_args(self, args: List[ast.AST]) -> Optional[str]:
+    def _label_from_args(self, args: Iterable[ast.AST]) -> Optional[str]:
         sql_label = None
         def scan_string(s: str):
             nonlocal sql_label
-            m = SQL_RE.search(s)
-            if m: sql_label = m.group(1).upper()
-            m2 = DB_NAME_RE.search(s)
-            if m2: self.databases.add(m2.group(1))
+            sql, db = _scan_sql_db(s)
+            if sql: sql_label = sql
+            if db: self.databases.add(db)
 
         for a in args:
-            if isinstance(a, ast.Constant) and isinstance(a.value, str):
+            if type(a) is ast.Constant and type(a.value) is str:
                 scan_string(a.value)
-            elif isinstance(a, ast.JoinedStr):  # f"SELECT ..." → concatenar literales
+            elif type(a) is ast.JoinedStr:  # f"SELECT ..." → concatenar literales
                 lit = "".join(p.value for p in a.values
-                              if isinstance(p, ast.Constant) and isinstance(p.value, str))
+                              if type(p) is ast.Constant and type(p.value) is str)
                 scan_string(lit)
-            elif isinstance(a, ast.Name):
+            elif type(a) is ast.Name:
                 if a.id in self.csql: sql_label = self.csql[a.id]
                 if a.id in self.cdb:  self.databases.add(self.cdb[a.id])
         return sql_label
 
+    def _add_edge(self, caller: str, tgt_mod: str, tgt_fn: str):
+        # clave del destino calculada una sola vez, al recolectar
+        self.edges.add((caller, intern(f"{tgt_mod}.{tgt_fn}" if "." not in tgt_fn else tgt_fn)))
+
     def _event_kwargs(self, caller: str, kwargs: List[ast.keyword]):
         for kw in kwargs:
             if not kw.arg or not kw.arg.startswith("on_"):
                 continue
             tgt_mod, tgt_fn = None, None
-            if isinstance(kw.value, ast.Attribute) and isinstance(kw.value.value, ast.Name):
+            if type(kw.value) is ast.Attribute and type(kw.value.value) is ast.Name:
                 base=kw.value.value.id; name=kw.value.attr
-                tgt_mod = self.imap.get(base, self.mod).split(".")[0]; tgt_fn = name
-            elif isinstance(kw.value, ast.Name):
-                name=kw.value.id; tgt_mod = self.imap.get(name, self.mod).split(".")[0]; tgt_fn = name
+                tgt_mod = self.iroot.get(base, self.mod_root); tgt_fn = name
+            elif type(kw.value) is ast.Name:
+                name=kw.value.id; tgt_mod = self.iroot.get(name, self.mod_root); tgt_fn = name
             else:
                 continue
-            self.edges.add((caller, tgt_mod, tgt_fn, kw.arg))
-
-    def visit_Call(self, node: ast.Call):
-        caller = self.cur()
-        if not caller:
-            return
-
-        # Qué se está llamando (mod estimado + símbolo)
-        cm, cf = self._resolve_call(node.func)
+            self._add_edge(caller, tgt_mod, tgt_fn)
 
-        # ---- Ajuste de CONTEXTO DE CLASE en el destino ----
+    def _class_target(self, node: ast.Call) -> Optional[str]:
+        """Destino calificado por CONTEXTO DE CLASE (mod.Clase), o None si no aplica."""
         # Caso A: self.metodo(...) / cls.metodo(...)
-        if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
+        if type(node.func) is ast.Attribute and type(node.func.value) is ast.Name:
             base = node.func.value.id
             if base in {"self", "cls"} and self.class_stack:
-                cm = f"{self.mod}.{self.class_stack[-1]}"
+                return f"{self.mod}.{self.class_stack[-1]}"
             # Caso B: ClassName.metodo(...) dentro del mismo módulo
             elif base in self.methods_by_class and base in (self.class_stack or [base]):
                 # si el "base" coincide con una clase actual/visible, cualifica a mod.Clase
-                cm = f"{self.mod}.{base}"
+                return f"{self.mod}.{base}"
         # Caso C: metodo(...) (nombre "desnudo" dentro de una clase actual)
-        elif isinstance(node.func, ast.Name) and self.class_stack:
+        elif type(node.func) is ast.Name and self.class_stack:
             cur_cls = self.class_stack[-1]
             if node.func.id in self.methods_by_class.get(cur_cls, set()):
-                cm = f"{self.mod}.{cur_cls}"
-
-        # ---- Detección DB/SQL (tal como ya la tienes) ----
-        # sqlite3.connect("file.db") o sqlite3.connect(DB_PATH)
-        if (isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name)
-            and cf == "connect" and self.imap.get(node.func.value.id, "").startswith("sqlite3")):
-            for a in list(node.args) + [kw.value for kw in node.keywords]:
-                if isinstance(a, ast.Constant) and isinstance(a.value, str):
-                    m = DB_NAME_RE.search(a.value)
-                    if m:
-                        self.databases.add(m.group(1))
-                elif isinstance(a, ast.Name):
-                    if a.id in self.cdb:
-                        self.databases.add(self.cdb[a.id])
-
-        # etiqueta SQL (constante, f-string o nombre)
-        sql_label = self._label_from_args(list(node.args) + [kw.value for kw in node.keywords]) # type: ignore
+                return f"{self.mod}.{cur_cls}"
+        return None
+
+    def _process_call(self, node: ast.Call, caller: str, cm: str, cf: str):
+        # ---- Detección DB/SQL ----
+        # etiqueta SQL y DBs (constante, f-string o nombre) en una sola pasada por los argumentos;
+        # cubre también sqlite3.connect("file.db") / sqlite3.connect(DB_PATH)
+        sql_label = self._label_from_args(chain(node.args, (kw.value for kw in node.keywords)))
 
         # Si llama a execute/executemany/executescript sin etiqueta, usa "SQL"
         if cf in {"execute", "executemany", "executescript"} and not sql_label:
@@ -283,56 +347,33 @@ class V(ast.NodeVisitor):
 
         # Aristas función→DB
         if sql_label and self.databases:
-            for db in sorted(self.databases):
-                self.db_edges.append((caller, db, sql_label))
+            # el orden lo fija el sort final en main
+            self.db_edges.update((caller, db, sql_label) for db in self.databases)
 
         # Eventos (on_*)
         self._event_kwargs(caller, node.keywords)
 
         # ---- Arista función→función con el módulo/clase correctamente cualificado ----
-        self.edges.add((caller, cm, cf, cf))
-
-        # Continuar recorriendo hijos
-        self.generic_visit(node)
-
-
-        # sqlite3.connect("file.db") o sqlite3.connect(DB_PATH)
-        if (isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name)
-            and cf == "connect" and self.imap.get(node.func.value.id, "").startswith("sqlite3")):
-            for a in list(node.args) + [kw.value for kw in node.keywords]:
-                if isinstance(a, ast.Constant) and isinstance(a.value, str):
-                    m = DB_NAME_RE.search(a.value)
-                    if m: self.databases.add(m.group(1))
-                elif isinstance(a, ast.Name):
-                    if a.id in self.cdb: self.databases.add(self.cdb[a.id])
-
-        # etiqueta SQL (constante, f-string o nombre de var)
-        sql_label = self._label_from_args(list(node.args) + [kw.value for kw in node.keywords]) # type: ignore
-
-        # Si llama a execute/executemany/executescript y aún no hay etiqueta, usa "SQL"
-        if cf in {"execute", "executemany", "executescript"} and not sql_label:
-            sql_label = "SQL"
-
-        # Si hay SQL pero ninguna DB identificada aún, usa una genérica
-        if sql_label and not self.databases:
-            self.databases.add("DB")
-
-        # Crear aristas función→DB si corresponde
-        if sql_label and self.databases:
-            for db in sorted(self.databases):
-                self.db_edges.append((caller, db, sql_label))
-
-        # Eventos (on_*)
-        self._event_kwargs(caller, node.keywords)
-
-        # Arista función→función normal
-        self.edges.add((caller, cm, cf, cf))
-        self.generic_visit(node)
+        self._add_edge(caller, cm, cf)
 
 # ---------------- IO helpers ----------------
 def _should_ignore(p: pathlib.Path)->bool:
     return any(seg in IGNORE_DIRS for seg in p.parts)
 
+def _walk_py(root: str, recurse: bool = True):
+    """.py bajo root vía os.scandir, podando IGNORE_DIRS antes de bajar."""
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            if recurse and e.name not in IGNORE_DIRS:
+                yield from _walk_py(e.path, recurse)
+        elif e.name.endswith(".py"):
+            yield pathlib.Path(e.path)
+
 def _iter_files(paths: Iterable[str], files: Iterable[str], no_rec: bool):
     seen=set()
     def add(p: pathlib.Path):
@@ -345,20 +386,53 @@ def _iter_files(paths: Iterable[str], files: Iterable[str], no_rec: bool):
     for d in paths:
         b=(ROOT/d).resolve()
         if not b.exists(): continue
-        it=b.glob("*.py") if no_rec else b.rglob("*.py")
-        for p in it:
-            if add(p): yield p
+        for p in _walk_py(str(b), not no_rec):
+            if p not in seen: seen.add(p); yield p
     if not paths and not files:
         # por defecto: nada (el batch script pasa --files)
         return
 
 def _parse_file(p: pathlib.Path):
-    src=p.read_text(encoding="utf-8",errors="ignore")
-    t=ast.parse(src); mod=p.with_suffix("").name
-    ir=ImportResolver(); ir.visit(t)
-    cc=ConstCollector(); cc.visit(t)
-    v=V(mod, src, ir.name_to_module, cc.sql_of, cc.db_of); v.visit(t)
-    return v
+    """Devuelve (mod, funcs, edges, databases, db_edges): tuplas simples, serializables entre procesos."""
+    src=p.read_bytes()  # bytes directo a ast.parse (sin decodificar a str)
+    try:
+        t=ast.parse(src, filename=str(p))
+    except (SyntaxError, ValueError):
+        t=ast.parse(src.decode("utf-8", errors="ignore"), filename=str(p))  # bytes no UTF-8: se ignoran
+    mod=p.with_suffix("").name
+    v=V(mod); v.visit(t)  # imports, constantes y llamadas en una sola pasada
+    return v.mod, v.funcs, v.edges, v.databases, v.db_edges
+
+def _cached_parse(path: pathlib.Path, use_cache: bool = True):
+    """_parse_file con caché en disco: .cache/generate_drawio/<hash(ruta, mtime, tamaño)>.pkl."""
+    if not use_cache:
+        return _parse_file(path)
+    st = path.stat()
+    key = hashlib.blake2b(f"{CACHE_VERSION}:{path}:{st.st_mtime_ns}:{st.st_size}".encode(), digest_size=16).hexdigest()
+    cpath = CACHE_DIR / f"{key}.pkl"
+    try:
+        with open(cpath, "rb") as fh:
+            return pickle.load(fh)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    result = _parse_file(path)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # escritura atómica: otra corrida (o un Ctrl-C) no deja un .pkl a medias en el caché
+    tmp = cpath.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    os.replace(tmp, cpath)
+    return result
+
+def _parse_all(files: List[pathlib.Path], use_cache: bool = True, jobs: Optional[int] = None):
+    """Parsea en paralelo (procesos: ast es CPU puro); con pocos archivos o jobs=1, secuencial."""
+    parse = partial(_cached_parse, use_cache=use_cache)
+    if len(files) < 4 or jobs == 1:
+        return [parse(p) for p in files]
+    workers = min(jobs or os.cpu_count() or 1, len(files))
+    # chunks chicos: con decenas de archivos, chunksize fijo dejaba núcleos ociosos
+    chunk = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(parse, files, chunksize=chunk))
 
 # ---------------- Utilidades de layout ----------------
 def topological_order_kahn(nodes: List[str], edges: List[Tuple[str,str]])->List[str]:
@@ -375,27 +449,66 @@ def topological_order_kahn(nodes: List[str], edges: List[Tuple[str,str]])->List[
             indeg[v]-=1
             if indeg[v]==0: q.append(v)
     if len(out)<len(nodes):  # hay ciclos: añade lo que falte por grado
-        rest=[n for n in nodes if n not in out]
-        rest.sort(key=lambda n: (-sum(1 for u,v in edges if u==n), n))
+        done=set(out)
+        rest=[n for n in nodes if n not in done]
+        outdeg=Counter(u for u,_ in edges)  # grado de salida, contado una vez
+        rest.sort(key=lambda n: (-outdeg[n], n))
         out+=rest
     return out
 
 # ---------------- Export draw.io ----------------
+# Igual que _esc(quote=True), pero en una sola pasada (str.translate)
+_HTML_TRANS = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+@lru_cache(maxsize=8192)
+def _esc(s: str) -> str:
+    return s.translate(_HTML_TRANS)
+
+# Plantillas de celdas en dos etapas: {campo} = invariante del export (paleta/estilo), se fija
+# una vez con _bake(); %s/%d = lo que cambia por celda, se llena con '%' en el loop.
+_T_LANE = ('<mxCell id="%s" value="%s" style="swimlane;rounded=1;fillColor={fill};fontColor={text};" '
+           'vertex="1" parent="1"><mxGeometry x="%d" y="%d" width="%d" height="%d" as="geometry"/></mxCell>')
+_T_FUNC = ('<mxCell id="%s" value="%s()" '
+           'style="rounded=1;whiteSpace=wrap;html=1;fillColor={fill};strokeColor={stroke};fontColor={text};" '
+           'vertex="1" parent="%s"><mxGeometry x="%d" y="%d" width="%d" height="%d" as="geometry"/></mxCell>')
+_T_DB = ('<mxCell id="%s" value="DB: %s" '
+         'style="ellipse;whiteSpace=wrap;fillColor={fill};strokeColor={stroke};fontColor={text};" '
+         'vertex="1" parent="%s"><mxGeometry x="%d" y="%d" width="200" height="70" as="geometry"/></mxCell>')
+_T_EDGE = ('<mxCell id="%s" style="{style}" edge="1" parent="1" source="%s" target="%s">'
+           '<mxGeometry relative="1" as="geometry"/></mxCell>')
+_T_EDGE_LBL = ('<mxCell id="%s" value="%s" style="{style}" edge="1" parent="1" source="%s" target="%s">'
+               '<mxGeometry relative="1" as="geometry"/></mxCell>')
+
+def _bake(tmpl: str, **const: str) -> str:
+    """Fija los campos invariantes de una plantilla (escapando '%'); queda solo el '%' por celda."""
+    return tmpl.format(**{k: v.replace("%", "%%") for k, v in const.items()})
+
 def export_drawio(by_mod: Dict[str,List[str]],
                   edges_ff: List[Tuple[str,str]],
                   db_nodes: Set[str],
                   edges_fd: List[Tuple[str,str,Optional[str]]],
-                  args) -> str:
+                  args) -> bytearray:
+    """XML draw.io ya codificado en UTF-8 (se arma en un bytearray, sin lista de strings).
+    Devuelve el mismo buffer (sin copiarlo a bytes): write_bytes acepta bytearray."""
     pal=style_palette(args.theme)
     lane_w, lane_h = 1000, 600
     node_w, node_h = 180, 54
     gap_x, gap_y = 220, 120
     cols = max(1, args.cols or 3)
 
-    out=[]
-    out.append(f'<mxfile host="app.diagrams.net" modified="{time.strftime("%Y-%m-%d %H:%M:%S")}" agent="gd_v32">')
-    out.append('<diagram id="Flow" name="Flow"><mxGraphModel><root>')
-    out.append('<mxCell id="0"/><mxCell id="1" parent="0"/>')
+    # plantillas con la paleta ya fija para todo el export
+    t_lane = _bake(_T_LANE, fill=pal["lane_fill"], text=pal["text"])
+    t_fn = _bake(_T_FUNC, fill=pal["func_fill"], stroke=pal["func_stroke"], text=pal["text"])
+    t_fn_db = _bake(_T_FUNC, fill=pal["db_fill"], stroke=pal["db_stroke"], text=pal["text"])
+    t_db = _bake(_T_DB, fill=pal["db_fill"], stroke=pal["db_stroke"], text=pal["text"])
+
+    buf=bytearray()
+    def w(line: str):
+        buf.extend(line.encode("utf-8")); buf.append(0x0A)
+
+    w(f'<mxfile host="app.diagrams.net" modified="{time.strftime("%Y-%m-%d %H:%M:%S")}" agent="gd_v32">')
+    w('<diagram id="Flow" name="Flow"><mxGraphModel><root>')
+    w('<mxCell id="0"/><mxCell id="1" parent="0"/>')
 
     def nid():
         nid.c+=1; return str(nid.c)
@@ -406,20 +519,28 @@ def export_drawio(by_mod: Dict[str,List[str]],
     fn_pos: Dict[str, Tuple[str,int,int,str]] = {}  # fn -> (lane_id, x, y, cell_id)
     db_pos: Dict[str,str] = {}                      # nombre DB -> id nodo DB
 
+    # funciones que tocan DB (una pasada sobre edges_fd, no una por nodo)
+    db_touchers = {u for (u,_,_) in edges_fd}
+    # etiquetas ya escapadas, calculadas antes de emitir (sin split/escape dentro del loop)
+    label_of = {fn: _esc(fn.rsplit(".", 1)[-1]) for fns in by_mod.values() for fn in fns}
+    # aristas internas de cada módulo, repartidas en una sola pasada (no una pasada por lane)
+    mod_of = {fn: mod for mod, fns in by_mod.items() for fn in fns}
+    edges_in_mod: Dict[str, List[Tuple[str,str]]] = defaultdict(list)
+    for u,v in edges_ff:
+        mu = mod_of.get(u)
+        if mu is not None and mod_of.get(v) == mu:
+            edges_in_mod[mu].append((u,v))
+
     # lanes por módulo
     x0,y0=40,40
     lane_gap=120
     x=x0
     for mod in sorted(by_mod.keys()):
         lid=nid(); lane_id[mod]=lid
-        out.append(
-            f'<mxCell id="{lid}" value="{html.escape(mod)}" style="swimlane;rounded=1;'
-            f'fillColor={pal["lane_fill"]};fontColor={pal["text"]};" vertex="1" parent="1">'
-            f'<mxGeometry x="{x}" y="{y0}" width="{lane_w}" height="{lane_h}" as="geometry"/></mxCell>'
-        )
+        w(t_lane % (lid, _esc(mod), x, y0, lane_w, lane_h))
         # funciones en una cuadrícula (topo order para algo de “naturalidad”)
         funcs = by_mod[mod]
-        order = topological_order_kahn(funcs, [(u,v) for u,v in edges_ff if u in funcs and v in funcs])
+        order = topological_order_kahn(funcs, edges_in_mod.get(mod, []))
         if not order: order = funcs[:]
         C = cols if cols>0 else max(1, int(math.sqrt(len(order))) )
         for i,fn in enumerate(order):
@@ -427,15 +548,7 @@ def export_drawio(by_mod: Dict[str,List[str]],
             xx = 40 + c*(node_w+ (gap_x-140))
             yy = 40 + r*(node_h+ (gap_y-66))
             cell=nid()
-            # ¿toca DB?
-            touches_db = any(u==fn for (u,_,_) in edges_fd)
-            fill = pal["db_fill"] if touches_db else pal["func_fill"]
-            stroke = pal["db_stroke"] if touches_db else pal["func_stroke"]
-            out.append(
-                f'<mxCell id="{cell}" value="{html.escape(fn.split(".")[-1])}()" '
-                f'style="rounded=1;whiteSpace=wrap;html=1;fillColor={fill};strokeColor={stroke};fontColor={pal["text"]};" '
-                f'vertex="1" parent="{lid}"><mxGeometry x="{xx}" y="{yy}" width="{node_w}" height="{node_h}" as="geometry"/></mxCell>'
-            )
+            w((t_fn_db if fn in db_touchers else t_fn) % (cell, label_of[fn], lid, xx, yy, node_w, node_h))
             fn_pos[fn]=(lid, xx, yy, cell)
         x += lane_w + lane_gap
 
@@ -443,56 +556,52 @@ def export_drawio(by_mod: Dict[str,List[str]],
     if args.include_db and (db_nodes or edges_fd):
         lid=nid(); lane_id["DATASOURCES"]=lid
         xd = x
-        out.append(
-            f'<mxCell id="{lid}" value="DATASOURCES" style="swimlane;rounded=1;fillColor={pal["lane_fill"]};fontColor={pal["text"]};" '
-            f'vertex="1" parent="1"><mxGeometry x="{xd}" y="{y0}" width="{lane_w//2}" height="{lane_h}" as="geometry"/></mxCell>'
-        )
+        w(t_lane % (lid, "DATASOURCES", xd, y0, lane_w//2, lane_h))
         for i,db in enumerate(sorted(db_nodes or {"DB"})):
             xx = 40; yy = 40 + i*120
             ndb=nid()
-            out.append(
-                f'<mxCell id="{ndb}" value="DB: {html.escape(db)}" '
-                f'style="ellipse;whiteSpace=wrap;fillColor={pal["db_fill"]};strokeColor={pal["db_stroke"]};fontColor={pal["text"]};" '
-                f'vertex="1" parent="{lid}"><mxGeometry x="{xx}" y="{yy}" width="200" height="70" as="geometry"/></mxCell>'
-            )
+            w(t_db % (ndb, _esc(db), lid, xx, yy))
             db_pos[db]=ndb
 
     # edges f->f (mismo estilo base)
-    edge_style = drawio_edge_style(args.edge_style, args.arrow, pal["edge"], False, args.line_jumps=="on")
+    t_edge = _bake(_T_EDGE, style=drawio_edge_style(args.edge_style, args.arrow, pal["edge"], False, args.line_jumps=="on"))
     for u,v in edges_ff:
         if u not in fn_pos or v not in fn_pos: continue
         sid=fn_pos[u][3]; tid=fn_pos[v][3]
-        out.append(
-            f'<mxCell id="{nid()}" style="{edge_style}" edge="1" parent="1" source="{sid}" target="{tid}">'
-            f'<mxGeometry relative="1" as="geometry"/></mxCell>'
-        )
+        w(t_edge % (nid(), sid, tid))
 
     # edges f->DB
     if args.include_db and edges_fd:
-        edge_style_db = drawio_edge_style(args.edge_style, args.arrow, pal["edge_db"], True, args.line_jumps=="on")
+        t_edge_db = _bake(_T_EDGE_LBL, style=drawio_edge_style(args.edge_style, args.arrow, pal["edge_db"], True, args.line_jumps=="on"))
         for u,db,label in edges_fd:
             sid = fn_pos.get(u, (None,None,None,None))[3]
             tid = db_pos.get(db) or db_pos.get("DB")
             if not (sid and tid): continue
-            lbl = html.escape(label or "") if args.label_edges else ""
-            out.append(
-                f'<mxCell id="{nid()}" value="{lbl}" style="{edge_style_db}" edge="1" parent="1" source="{sid}" target="{tid}">'
-                f'<mxGeometry relative="1" as="geometry"/></mxCell>'
-            )
+            lbl = _esc(label or "") if args.label_edges else ""
+            w(t_edge_db % (nid(), lbl, sid, tid))
 
     # leyenda
     if args.legend == "on":
         leg_id=nid()
-        out.append(
+        w(
             f'<mxCell id="{leg_id}" value="Legend&#xa;• Node (red): touches DB&#xa;• Dashed edge: inter-module&#xa;• Style: {args.theme}/{args.edge_style}/{args.arrow}&#xa;• Generated: {time.strftime("%Y-%m-%d %H:%M:%S")}" '
             f'style="rounded=1;whiteSpace=wrap;html=1;fillColor={pal["legend"]};strokeColor={pal["func_stroke"]};fontColor={pal["text"]};" vertex="1" parent="1">'
             f'<mxGeometry x="{x0+40}" y="{y0+lane_h-80}" width="340" height="110" as="geometry"/></mxCell>'
         )
 
-    out.append('</root></mxGraphModel></diagram></mxfile>')
-    return "\n".join(out)
+    buf.extend(b'</root></mxGraphModel></diagram></mxfile>')
+    return buf
 
 # ---------------- Export Mermaid (sencillo) ----------------
+# ids de nodo: el mismo nombre aparece en subgraph y en cada arista; se arma una vez
+@lru_cache(maxsize=8192)
+def _mmd_node(name: str) -> str:
+    return name.replace(".", "_")
+
+@lru_cache(maxsize=1024)
+def _mmd_db(db: str) -> str:
+    return "db_" + db.replace(".", "_").replace("/", "_")
+
 def export_mermaid(by_mod: Dict[str,List[str]],
                    edges_ff: List[Tuple[str,str]],
                    db_nodes: Set[str],
@@ -505,19 +614,18 @@ def export_mermaid(by_mod: Dict[str,List[str]],
     for mod in sorted(by_mod):
         lines.append(f"  subgraph {mod}")
         for fn in by_mod[mod]:
-            node = fn.replace(".","_")
-            lines.append(f"    {node}[{fn.split('.')[-1]}()]")
+            lines.append(f"    {_mmd_node(fn)}[{fn.rsplit('.', 1)[-1]}()]")
         lines.append("  end")
     # dbs
     for db in sorted(db_nodes or {"DB"}):
-        lines.append(f"  db_{db.replace('.','_').replace('/','_')}(({db})):::db")
+        lines.append(f"  {_mmd_db(db)}(({db})):::db")
     # edges f->f
     for u,v in edges_ff:
-        lines.append(f"  {u.replace('.','_')} --> {v.replace('.','_')}")
+        lines.append(f"  {_mmd_node(u)} --> {_mmd_node(v)}")
     # edges f->db
     for u,db,label in edges_fd:
         lbl = f'|{label}|' if (args.label_edges and label) else ""
-        lines.append(f"  {u.replace('.','_')} -- {lbl} --> db_{db.replace('.','_').replace('/','_')}")
+        lines.append(f"  {_mmd_node(u)} -- {lbl} --> {_mmd_db(db)}")
     lines.append("classDef db fill:#ffdede,stroke:#d43c3c;")
     return "\n".join(lines)
 
@@ -542,6 +650,8 @@ def main():
     ap.add_argument("--cols", type=int, default=3)
     ap.add_argument("--export", nargs="*", default=["drawio"], choices=["drawio","mermaid"])
     ap.add_argument("--outfile", default=str(DOCS/"flow.drawio"))
+    ap.add_argument("--no-cache", action="store_true", help="No usar el caché de parseo (.cache/generate_drawio)")
+    ap.add_argument("--jobs", type=int, default=None, help="Procesos para parsear (1 = secuencial; por defecto nº de CPUs)")
     args=ap.parse_args()
 
     # Parsear todos los archivos
@@ -550,44 +660,39 @@ def main():
         print("[WARN] No se recibieron archivos. Usa --files o --paths.")
         return
 
-    by_mod: Dict[str,List[str]] = defaultdict(list)
+    # dict como set ordenado: acumula y deduplica en la misma pasada
+    mod_funcs: Dict[str,Dict[str,None]] = defaultdict(dict)
     edges_ff_set: Set[Tuple[str,str]] = set()
     db_nodes: Set[str] = set()
-    edges_fd: List[Tuple[str,str,Optional[str]]] = []
+    edges_fd_set: Set[Tuple[str,str,Optional[str]]] = set()
 
-    for p in files:
-        v=_parse_file(p)
+    for mod, v_funcs, v_edges, v_databases, v_db_edges in _parse_all(files, not args.no_cache, args.jobs):
         # filtro private si corresponde
-        funcs = sorted(f for f in v.funcs if not (args.hide_private and f.split(".")[-1].startswith("_")))
-        by_mod[v.mod].extend(funcs)
-        # f->f: convierte a calificados
-        for (u, tgt_mod, tgt_fn, _lab) in v.edges:
-            u2=u
-            v2 = f"{tgt_mod}.{tgt_fn}" if "." not in tgt_fn else tgt_fn
-            edges_ff_set.add((u2, v2))
+        mod_funcs[mod].update(dict.fromkeys(sorted(
+            f for f, short in v_funcs.items() if not (args.hide_private and short.startswith("_")))))
+        # f->f: pares (u, destino calificado) ya deduplicados en V; merge set-a-set en C
+        edges_ff_set |= v_edges
         # DBs
-        db_nodes |= set(v.databases)
-        edges_fd.extend(v.db_edges)
+        db_nodes.update(v_databases)
+        edges_fd_set |= v_db_edges
 
-    # dedup y orden por módulo
-    for mod in list(by_mod):
-        seen=set(); uniq=[]
-        for f in by_mod[mod]:
-            if f not in seen: seen.add(f); uniq.append(f)
-        by_mod[mod]=uniq
+    by_mod: Dict[str,List[str]] = {mod: list(fs) for mod, fs in mod_funcs.items()}
 
-    xml = export_drawio(by_mod, sorted(edges_ff_set), db_nodes, edges_fd, args)
+    # orden determinista (el set depende del hash); se ordena una sola vez para ambos exports
+    edges_ff = sorted(edges_ff_set)
+    edges_fd = sorted(edges_fd_set)  # label siempre es str (solo se agregan con sql_label)
 
     out = pathlib.Path(args.outfile)
     out.parent.mkdir(parents=True, exist_ok=True)
+    # el XML solo se arma si se pidió (con --export mermaid no se construye)
     if any(e.lower()=="drawio" for e in args.export):
-        out.write_text(xml, encoding="utf-8")
+        out.write_bytes(export_drawio(by_mod, edges_ff, db_nodes, edges_fd, args))
         print(f"OK draw.io → {out}")
 
     if any(e.lower()=="mermaid" for e in args.export):
-        mmd = export_mermaid(by_mod, sorted(edges_ff_set), db_nodes, edges_fd, args)
+        mmd = export_mermaid(by_mod, edges_ff, db_nodes, edges_fd, args)
         mmd_path = out.with_suffix(".mmd") if out.suffix == ".drawio" else (DOCS/"flow.mmd")
-        mmd_path.write_text(mmd, encoding="utf-8")
+        mmd_path.write_bytes(mmd.encode("utf-8"))
         print(f"OK mermaid → {mmd_path}")
 
 if __name__=="__main__":
@@ -4,63 +4,66 @@
 Mermaid v2.1: subgraphs por módulo + imports + DB + etiquetas + callbacks Kivy + constantes SQL.
 Salida: docs/flow.md
 """
-import ast, argparse, pathlib, re
-from collections import defaultdict
+import ast, argparse, hashlib, os, pathlib, pickle, re, sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain, groupby
 from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+# como paquete (python -m tools_main.X) o como script (python3 tools_main/X.py)
+if __package__:
+    from ._common_parse import FileKey, file_key, parse_source, read_source
+else:
+    from _common_parse import FileKey, file_key, parse_source, read_source
+
 ROOT = pathlib.Path(__file__).resolve().parents[1]
 DOCS = ROOT / "docs"; DOCS.mkdir(exist_ok=True)
-IGNORE_DIRS = {".venv","venv","__pycache__","build","dist",".buildozer","jni","external",".git",".idea",".vscode"}
+CACHE_DIR = ROOT / ".cache" / "generate_mermaid"
+CACHE_VERSION = 2  # subir si cambia lo que devuelve _parse_module
+IGNORE_DIRS = frozenset({".venv","venv","__pycache__","build","dist",".buildozer","jni","external",".git",".idea",".vscode"})
 
 SQL_RE = re.compile(r'(?is)\b(SELECT|INSERT|UPDATE|DELETE)\b')
 DB_NAME_RE = re.compile(r'(?i)([A-Za-z0-9_\-]+\.db)')
-
-# ---------- Colección de constantes SQL/DB ----------
-class ConstCollector(ast.NodeVisitor):
-    def __init__(self):
-        self.sql_of: Dict[str, str] = {}     # nombre -> op SQL (SELECT/INSERT/...)
-        self.db_of: Dict[str, str]  = {}     # nombre -> db.sqlite
-
-    def visit_Assign(self, node: ast.Assign):
-        if not isinstance(node.value, ast.Constant) or not isinstance(node.value.value, str):
-            return
-        s = node.value.value
-        sql = None; db = None
+_SQL_VERBS = ("select", "insert", "update", "delete")
+_DBID_RE = re.compile(r'[^A-Za-z0-9_]')  # id Mermaid de un nodo DB
+
+@lru_cache(maxsize=8192)
+def _scan_sql_db(s: str) -> Tuple[Optional[str], Optional[str]]:
+    """(verbo SQL en mayúsculas, nombre .db) de un literal. Descarte barato por substring antes
+    de la regex (la mayoría de los strings no tienen ni verbo ni '.db'); memoizado por string."""
+    sl = s.lower()
+    sql = db = None
+    if any(k in sl for k in _SQL_VERBS):
         m = SQL_RE.search(s)
         if m: sql = m.group(1).upper()
+    if ".db" in sl:
         m2 = DB_NAME_RE.search(s)
         if m2: db = m2.group(1)
-        if not sql and not db: return
-        for t in node.targets:
-            if isinstance(t, ast.Name):
-                if sql: self.sql_of[t.id] = sql
-                if db:  self.db_of[t.id]  = db
-
-# ---------- Imports ----------
-class ImportResolver(ast.NodeVisitor):
-    def __init__(self):
-        self.name_to_module: Dict[str,str] = {}
-    def visit_Import(self, node: ast.Import):
-        for alias in node.names:
-            mod = alias.name
-            asname = alias.asname or mod.split(".")[-1]
-            self.name_to_module[asname] = mod
-    def visit_ImportFrom(self, node: ast.ImportFrom):
-        if node.module is None: return
-        base = node.module
-        for alias in node.names:
-            local = alias.asname or alias.name
-            self.name_to_module[local] = base
+    return sql, db
+
+# campos con hijos AST por tipo de nodo, ya invertidos para apilar (último campo primero).
+# Name/Constant no tienen hijos que importen y ctx siempre es Load/Store/Del: no se recorren.
+_CHILD_FIELDS: Dict[type, Tuple[str, ...]] = {ast.Name: (), ast.Constant: ()}
+
+def _child_fields(t: type) -> Tuple[str, ...]:
+    fields = _CHILD_FIELDS.get(t)
+    if fields is None:
+        fields = _CHILD_FIELDS[t] = tuple(f for f in reversed(t._fields) if f != "ctx")
+    return fields
 
 # ---------- Call graph ----------
-class CallGraphVisitor(ast.NodeVisitor):
-    def __init__(self, module_name: str, src: str, import_map: Dict[str,str],
-                 const_sql: Dict[str,str], const_db: Dict[str,str]):
+class CallGraphVisitor:
+    """Una sola pasada por el AST (DFS iterativo, despacho por type()) que junta imports,
+    constantes SQL/DB y llamadas. Las llamadas se resuelven al terminar el recorrido, con los
+    imports/constantes de todo el módulo ya vistos (igual que con pasadas separadas)."""
+    _END_FUNC = object()  # marca en la pila: salir de la función actual
+
+    def __init__(self, module_name: str):
         self.module = module_name
-        self.src = src
-        self.import_map = import_map
-        self.const_sql = const_sql
-        self.const_db  = const_db
+        self.import_map: Dict[str,str] = {}   # nombre local -> módulo
+        self.const_sql: Dict[str,str] = {}    # nombre -> op SQL (SELECT/INSERT/...)
+        self.const_db: Dict[str,str]  = {}    # nombre -> db.sqlite
+        self._calls: List[Tuple[ast.Call, str]] = []  # (Call, caller) pendientes de resolver
 
         self._stack: List[str] = []
         self.funcs: Set[str] = set()
@@ -68,38 +71,90 @@ class CallGraphVisitor(ast.NodeVisitor):
         self.edges: Set[Tuple[str,str,str,Optional[str]]] = set()
 
         self.databases: Set[str] = set()
-        self.db_edges: List[Tuple[str,str,Optional[str]]] = []
+        self.db_edges: Set[Tuple[str,str,Optional[str]]] = set()  # mismo SQL repetido -> una arista
 
     def _current(self): return self._stack[-1] if self._stack else None
 
-    def visit_FunctionDef(self, node: ast.FunctionDef):
-        fn = f"{self.module}.{node.name}"
-        self.funcs.add(fn)
-        self._stack.append(fn)
-        self.generic_visit(node)
-        self._stack.pop()
+    def visit(self, tree: ast.AST):
+        end_func = self._END_FUNC; AST = ast.AST
+        work: List[object] = [tree]
+        while work:
+            node = work.pop()
+            if node is end_func:
+                self._stack.pop(); continue
+            t = type(node)
+            if t is ast.FunctionDef or t is ast.AsyncFunctionDef:
+                fn = f"{self.module}.{node.name}"  # type: ignore[attr-defined]
+                self.funcs.add(fn)
+                self._stack.append(fn)
+                work.append(end_func)
+            elif t is ast.Call:
+                caller = self._current()
+                if not caller:
+                    continue  # llamada fuera de función: no se baja (igual que antes)
+                self._calls.append((node, caller))  # type: ignore[arg-type]
+            elif t is ast.Import or t is ast.ImportFrom:
+                self._collect_import(node)  # type: ignore[arg-type]
+                continue
+            elif t is ast.Assign:
+                self._collect_const(node)  # type: ignore[arg-type]
+            # hijos en orden inverso: el primero sale primero (mismo orden que generic_visit),
+            # leyendo los campos directo en vez de pasar por ast.iter_child_nodes
+            for name in _child_fields(t):
+                v = getattr(node, name, None)
+                if type(v) is list:
+                    work.extend([x for x in reversed(v) if isinstance(x, AST)])
+                elif isinstance(v, AST):
+                    work.append(v)
+
+        for node, caller in self._calls:
+            self._visit_call(node, caller)
+        self._calls.clear()
+
+    # ---- imports / constantes ----
+    # se recogen en el mismo recorrido que las llamadas, también dentro de funciones (imports
+    # perezosos): los mapas son de todo el módulo y no hay pasada aparte que recortar
+    def _collect_import(self, node: ast.AST):
+        if type(node) is ast.Import:
+            for alias in node.names:
+                mod = alias.name
+                asname = alias.asname or mod.split(".")[-1]
+                self.import_map[asname] = mod
+            return
+        if node.module is None: return  # type: ignore[attr-defined]
+        base = node.module  # type: ignore[attr-defined]
+        for alias in node.names:  # type: ignore[attr-defined]
+            local = alias.asname or alias.name
+            self.import_map[local] = base
 
-    def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
-        self.visit_FunctionDef(node)
+    def _collect_const(self, node: ast.Assign):
+        if not isinstance(node.value, ast.Constant) or not isinstance(node.value.value, str):
+            return
+        sql, db = _scan_sql_db(node.value.value)
+        if not sql and not db: return
+        for t in node.targets:
+            if isinstance(t, ast.Name):
+                if sql: self.const_sql[t.id] = sql
+                if db:  self.const_db[t.id]  = db
 
     # ---- helpers ----
     def _resolve_call(self, node: ast.AST) -> Tuple[str,str]:
         if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
             base = node.value.id; func = node.attr
             if base in self.import_map:
-                return (self.import_map[base].split(".")[0], func)
+                return (sys.intern(self.import_map[base].split(".")[0]), func)
             return (self.module, func)
         if isinstance(node, ast.Name):
             name = node.id
             if name in self.import_map:
-                return (self.import_map[name].split(".")[0], name)
+                return (sys.intern(self.import_map[name].split(".")[0]), name)
             return (self.module, name)
         return (self.module, "<call>")
 
-    def _label_from_args(self, args: List[ast.AST]) -> Optional[str]:
-        # Busca SQL en strings o en nombres constantes
+    def _label_from_args(self, args: List[ast.expr], kwargs: List[ast.keyword]) -> Optional[str]:
+        # Busca SQL en strings o en nombres constantes (posicionales y luego valores de kwargs)
         sql_label = None
-        for a in args:
+        for a in chain(args, (kw.value for kw in kwargs)):
             v = None; db = None
             if isinstance(a, ast.Constant) and isinstance(a.value, str):
                 v = a.value
@@ -107,24 +162,21 @@ class CallGraphVisitor(ast.NodeVisitor):
                 if a.id in self.const_sql: sql_label = self.const_sql[a.id]
                 if a.id in self.const_db:  self.databases.add(self.const_db[a.id])
             if v:
-                m = SQL_RE.search(v)
-                if m: sql_label = m.group(1).upper()
-                m2 = DB_NAME_RE.search(v)
-                if m2: self.databases.add(m2.group(1))
+                sql, db = _scan_sql_db(v)
+                if sql: sql_label = sql
+                if db: self.databases.add(db)
         return sql_label
 
     def _edge(self, caller: str, mod: str, func: str, label: Optional[str]):
         self.edges.add((caller, mod, func, label))
 
     def _edge_db(self, caller: str, db: str, op: Optional[str]):
-        self.db_edges.append((caller, db, op))
+        self.db_edges.add((caller, db, op))
 
     def _try_event_kwargs(self, caller: str, callnode: ast.Call, kwargs: List[ast.keyword]):
         # Button(..., on_release=self.generate_pdf)  / bind(on_release=self.go_back)
         for kw in kwargs:
-            if not kw.arg: 
-                continue
-            if not kw.arg.startswith("on_"):
+            if not kw.arg or not kw.arg.startswith("on_"):  # **kw (arg None) o no es evento
                 continue
             target_mod, target_fn = None, None
             if isinstance(kw.value, ast.Attribute) and isinstance(kw.value.value, ast.Name):
@@ -141,11 +193,7 @@ class CallGraphVisitor(ast.NodeVisitor):
                 continue
             self._edge(caller, target_mod, target_fn, kw.arg)  # label: on_release/on_press
 
-    def visit_Call(self, node: ast.Call):
-        caller = self._current()
-        if not caller:
-            return
-
+    def _visit_call(self, node: ast.Call, caller: str):
         callee_mod, callee_func = self._resolve_call(node.func)
 
         # sqlite3.connect("file.db")
@@ -157,62 +205,131 @@ class CallGraphVisitor(ast.NodeVisitor):
         )
         if is_sqlite_connect:
             # intenta leer "*.db" de args/kwargs
-            for a in list(node.args) + [kw.value for kw in node.keywords]:
+            for a in chain(node.args, (kw.value for kw in node.keywords)):
                 if isinstance(a, ast.Constant) and isinstance(a.value, str):
-                    m = DB_NAME_RE.search(a.value)
-                    if m:
-                        self.databases.add(m.group(1))
+                    db = _scan_sql_db(a.value)[1]
+                    if db:
+                        self.databases.add(db)
 
         # SQL label desde args (strings o constantes)
-        sql_label = self._label_from_args(list(node.args) + [kw.value for kw in node.keywords])
+        sql_label = self._label_from_args(node.args, node.keywords)
         if sql_label and self.databases:
             for db in sorted(self.databases):
                 self._edge_db(caller, db, sql_label)
 
-        # callbacks Kivy en kwargs y en bind()
-        if callee_func == "bind":
-            self._try_event_kwargs(caller, node, node.keywords)
-        else:
-            # constructor Button(..., on_release=...)
+        # callbacks Kivy en kwargs: bind(on_release=...) y constructor Button(..., on_release=...)
+        if node.keywords:
             self._try_event_kwargs(caller, node, node.keywords)
 
         # arista normal
         self._edge(caller, callee_mod, callee_func, callee_func)
-        self.generic_visit(node)
 
 # ---------- IO / parse ----------
 def _should_ignore(p: pathlib.Path) -> bool:
     return any(seg in IGNORE_DIRS for seg in p.parts)
 
+def _walk_py(root: str, recurse: bool = True):
+    """.py bajo root vía os.scandir, podando IGNORE_DIRS antes de bajar (no se recorre .venv/ etc.)."""
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            if recurse and e.name not in IGNORE_DIRS:
+                yield from _walk_py(e.path, recurse)
+        elif e.name.endswith(".py"):
+            yield pathlib.Path(e.path)
+
 def _iter_py_files(paths: Iterable[str], files: Iterable[str], no_recurse: bool):
     seen=set()
     def add(p: pathlib.Path):
         if p.suffix==".py" and not _should_ignore(p) and p not in seen:
             seen.add(p); return True
         return False
+    # normpath y no resolve(): colapsa ./ y ../ sin el realpath (un stat por componente)
     for f in files:
-        p=(ROOT/f).resolve()
+        p=pathlib.Path(os.path.normpath(ROOT/f))
         if p.is_file() and add(p): yield p
+    # lo que sale de _walk_py ya viene podado: basta con deduplicar
     for d in paths:
-        b=(ROOT/d).resolve()
-        if not b.exists(): continue
-        it = b.glob("*.py") if no_recurse else b.rglob("*.py")
-        for p in it:
-            if add(p): yield p
+        b=os.path.normpath(ROOT/d)
+        if not os.path.isdir(b): continue
+        for p in _walk_py(b, not no_recurse):
+            if p not in seen: seen.add(p); yield p
     if not paths and not files:
-        for p in ROOT.rglob("*.py"):
-            if add(p): yield p
-
-def _parse_module(path: pathlib.Path):
-    src = path.read_text(encoding="utf-8", errors="ignore")
-    tree = ast.parse(src)
-    mod = path.with_suffix("").name
-    ir = ImportResolver(); ir.visit(tree)
-    cc = ConstCollector(); cc.visit(tree)
-    v = CallGraphVisitor(mod, src, ir.name_to_module, cc.sql_of, cc.db_of)
+        for p in _walk_py(str(ROOT)):
+            if p not in seen: seen.add(p); yield p
+
+def _parse_module(path: pathlib.Path, key: Optional[FileKey] = None):
+    """Devuelve (module, funcs, edges, databases, db_edges, entry): datos simples, pickleables.
+    'key' es el file_key ya calculado por _cached_parse (evita un segundo stat)."""
+    key = key or file_key(path)
+    src = read_source(key)
+    mod = sys.intern(path.with_suffix("").name)  # se repite en cada función y arista del módulo
+    # el texto solo hace falta para detectar el entry; el visitor trabaja con el árbol
+    entry = f"{mod}.__main__" if (b"__name__" in src and b"__main__" in src) else None
+    tree = parse_source(key)  # compartido con analyze_sql si corren en el mismo proceso
+    v = CallGraphVisitor(mod)
     v.visit(tree)
-    entry = f"{mod}.__main__" if ("__name__" in src and "__main__" in src) else None
-    return v, entry
+    return v.module, v.funcs, v.edges, v.databases, v.db_edges, entry
+
+def _cached_parse(path: pathlib.Path, use_cache: bool = True):
+    """_parse_module con caché en disco: .cache/generate_mermaid/<hash(ruta, mtime, tamaño)>.pkl."""
+    if not use_cache:
+        return _parse_module(path)
+    fkey = file_key(path)  # un solo stat: clave del caché en disco y de _common_parse
+    key = hashlib.blake2b(f"{CACHE_VERSION}:{path}:{fkey[1]}:{fkey[2]}".encode(), digest_size=16).hexdigest()
+    cpath = CACHE_DIR / f"{key}.pkl"
+    try:
+        with open(cpath, "rb") as fh:
+            return pickle.load(fh)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    result = _parse_module(path, fkey)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # escritura atómica: otra corrida (o un Ctrl-C) no deja un .pkl a medias en el caché
+    tmp = cpath.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    os.replace(tmp, cpath)
+    return result
+
+def _safe_parse(path: pathlib.Path, use_cache: bool = True):
+    """(resultado, None) o (None, error): un archivo roto no tumba el pool."""
+    try:
+        return _cached_parse(path, use_cache), None
+    except Exception as ex:
+        return None, str(ex)
+
+def _use_threads(pool: str) -> bool:
+    """'auto': hilos solo en CPython sin GIL (3.13t); con GIL, ast.parse no escala en hilos."""
+    if pool != "auto":
+        return pool == "thread"
+    gil = getattr(sys, "_is_gil_enabled", None)
+    return gil is not None and not gil()
+
+def _parse_all(files: List[pathlib.Path], use_cache: bool = True, jobs: Optional[int] = None,
+               pool: str = "auto"):
+    """Parsea en paralelo (procesos, o hilos sin GIL / --pool thread); con pocos archivos o jobs=1, secuencial.
+    Cada tarea devuelve su propio resultado: no hay estado compartido que proteger."""
+    parse = partial(_safe_parse, use_cache=use_cache)
+    if len(files) < 4 or jobs == 1:
+        return [parse(p) for p in files]
+    if _use_threads(pool):
+        # sin costo de fork/pickle: sirve también en repos chicos donde arrancar procesos domina
+        with ThreadPoolExecutor(max_workers=min(32, jobs or 2 * (os.cpu_count() or 1))) as ex:
+            return list(ex.map(parse, files))
+    workers = min(jobs or os.cpu_count() or 1, len(files))
+    chunk = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(parse, files, chunksize=chunk))
+
+def _edge_key(e: Tuple[str,str,str,Optional[str]]) -> Tuple[str,str,str,str]:
+    return (e[0], e[1], e[2], e[3] or "")
+
+def _db_edge_key(e: Tuple[str,str,Optional[str]]) -> Tuple[str,str,str]:
+    return (e[0], e[1], e[2] or "")
 
 # ---------- main ----------
 def main():
@@ -221,81 +338,97 @@ def main():
     ap.add_argument("--files", nargs="*", default=[])
     ap.add_argument("--no_recurse", action="store_true")
     ap.add_argument("--modules", nargs="*", default=[])
-    ap.add_argument("--exclude_mods", nargs="*", default=["generate_mermaid","generate_drawio","analyze_sql"])
+    ap.add_argument("--exclude_mods", nargs="*", default=["generate_mermaid","generate_drawio","analyze_sql","docs_all","_common_parse"])
     ap.add_argument("--hide_private", action="store_true")
     ap.add_argument("--inter_module_only", action="store_true")
     ap.add_argument("--include_db", action="store_true")
     ap.add_argument("--label_edges", action="store_true")
     ap.add_argument("--outfile", default="docs/flow.md")
+    ap.add_argument("--no-cache", action="store_true", help="No usar el caché de parseo (.cache/generate_mermaid)")
+    ap.add_argument("--jobs", type=int, default=None, help="Procesos para parsear (1 = secuencial; por defecto nº de CPUs)")
+    ap.add_argument("--pool", default="auto", choices=["auto","process","thread"],
+                    help="Paralelismo del parseo: auto = hilos si el intérprete no tiene GIL, si no procesos")
     args = ap.parse_args()
 
-    visitors: List[CallGraphVisitor] = []
+    parsed = []  # (funcs, edges, databases, db_edges) por archivo
     entries = set()
-    for p in _iter_py_files(args.paths, args.files, args.no_recurse):
-        try:
-            v, entry = _parse_module(p)
-            visitors.append(v)
-            if entry: entries.add(entry)
-        except Exception as ex:
-            print(f"[WARN] {p}: {ex}")
-
-    funcs = set().union(*(v.funcs for v in visitors))
-    if args.modules:  funcs = {fn for fn in funcs if fn.split(".")[0] in set(args.modules)}
-    if args.exclude_mods: funcs = {fn for fn in funcs if fn.split(".")[0] not in set(args.exclude_mods)}
-    if args.hide_private: funcs = {fn for fn in funcs if not fn.split(".")[-1].startswith("_")}
+    files = list(_iter_py_files(args.paths, args.files, args.no_recurse))
+    for p, (res, err) in zip(files, _parse_all(files, not args.no_cache, args.jobs, args.pool)):
+        if res is None:
+            print(f"[WARN] {p}: {err}")
+            continue
+        _mod, v_funcs, v_edges, v_databases, v_db_edges, entry = res
+        parsed.append((v_funcs, v_edges, v_databases, v_db_edges))
+        if entry: entries.add(entry)
+
+    all_funcs: Set[str] = set()
+    for v_funcs, _, _, _ in parsed:
+        all_funcs.update(v_funcs)
+    # módulo de cada función: un split por función (se usa en filtros, aristas y subgraphs)
+    mod_of = {fn: sys.intern(fn.split(".", 1)[0]) for fn in all_funcs}
+    only_mods = frozenset(args.modules) if args.modules else None
+    skip_mods = frozenset(args.exclude_mods)
+    # los tres filtros en una sola pasada
+    funcs = {fn for fn in all_funcs
+             if (only_mods is None or mod_of[fn] in only_mods)
+             and mod_of[fn] not in skip_mods
+             and not (args.hide_private and fn.rsplit(".", 1)[-1].startswith("_"))}
 
     edges: Set[Tuple[str,str,str,Optional[str]]] = set()
     db_nodes: Set[str] = set()
-    db_edges: List[Tuple[str,str,Optional[str]]] = []
+    db_edges: Set[Tuple[str,str,Optional[str]]] = set()
 
-    for v in visitors:
-        for (caller, callee_mod, callee_fn, label) in v.edges:
+    for _funcs, v_edges, v_databases, v_db_edges in parsed:
+        for (caller, callee_mod, callee_fn, label) in v_edges:
             if caller in funcs:
-                if args.inter_module_only and (caller.split(".")[0] == callee_mod):
+                if args.inter_module_only and (mod_of[caller] == callee_mod):
                     continue
                 edges.add((caller, callee_mod, callee_fn, label))
         if args.include_db:
-            db_nodes |= v.databases
-            for item in v.db_edges:
-                if item[0] in funcs:
-                    db_edges.append(item)
+            db_nodes |= v_databases
+            db_edges.update(item for item in v_db_edges if item[0] in funcs)
 
-    by_mod = defaultdict(set)
-    for fn in funcs: by_mod[fn.split(".")[0]].add(fn)
+    # un solo sort por (módulo, función): groupby da cada subgraph ya ordenado y contiguo
+    funcs_sorted = sorted(funcs, key=lambda fn: (mod_of[fn], fn))
 
     out = (ROOT / args.outfile).resolve()
     out.parent.mkdir(parents=True, exist_ok=True)
-    with out.open("w", encoding="utf-8") as f:
-        f.write("# Diagrama de flujo (Mermaid)\n\n")
-        f.write("%%{init: {'flowchart': {'curve':'basis','nodeSpacing':60,'rankSpacing':90}, 'themeVariables': {'fontSize':'18px'}} }%%\n")
-        f.write("```mermaid\nflowchart TD\n")
-        for mod in sorted(by_mod):
-            f.write(f"  subgraph {mod}\n")
-            for fn in sorted(by_mod[mod]):
-                nid = fn.replace(".","_"); label = fn.split(".")[-1]+"()"
-                f.write(f'    {nid}["{label}"]\n')
-            f.write("  end\n")
-        if args.include_db and db_nodes:
-            f.write("  subgraph DATASOURCES\n")
-            for db in sorted(db_nodes):
-                dbid = "db_" + re.sub(r'[^A-Za-z0-9_]', '_', db)
-                f.write(f'    {dbid}(["DB: {db}"])\n')
-            f.write("  end\n")
-        for en in sorted(entries):
-            f.write(f'  {en.replace(".","_")}(["{en}"]):::entry\n')
-        for caller, callee_mod, callee_fn, label in sorted(edges):
-            sa = caller.replace(".","_"); sb = f"{callee_mod}_{callee_fn}"
-            style = "-->" if caller.split(".")[0]==callee_mod else "-.->"
-            if args.label_edges and label:
-                f.write(f"  {sa} {style} |{label}| {sb}\n")
-            else:
-                f.write(f"  {sa} {style} {sb}\n")
-        if args.include_db:
-            for caller, db, op in db_edges:
-                sa = caller.replace(".","_"); dbid = "db_" + re.sub(r'[^A-Za-z0-9_]', '_', db)
-                lbl = f"|{op}|" if (args.label_edges and op) else ""
-                f.write(f"  {sa} -.-> {lbl} {dbid}\n")
-        f.write("classDef entry stroke-width:2px,stroke-dasharray:4 2;\n```\n")
+    # ids Mermaid de cada función, una vez (se usan en el subgraph y en cada arista)
+    node_id = {fn: fn.replace(".", "_") for fn in funcs}
+
+    # documento completo en memoria y una sola escritura (sin un f.write por línea)
+    parts: List[str] = []
+    w = parts.append
+    w("# Diagrama de flujo (Mermaid)\n\n")
+    w("%%{init: {'flowchart': {'curve':'basis','nodeSpacing':60,'rankSpacing':90}, 'themeVariables': {'fontSize':'18px'}} }%%\n")
+    w("```mermaid\nflowchart TD\n")
+    for mod, group in groupby(funcs_sorted, key=mod_of.__getitem__):
+        w(f"  subgraph {mod}\n")
+        for fn in group:
+            w(f'    {node_id[fn]}["{fn.rsplit(".", 1)[-1]}()"]\n')
+        w("  end\n")
+    # id de cada DB una vez (nodos y aristas); una arista puede apuntar a una DB sin nodo
+    dbid_of = {db: "db_" + _DBID_RE.sub("_", db) for db in db_nodes.union(e[1] for e in db_edges)}
+    if args.include_db and db_nodes:
+        w("  subgraph DATASOURCES\n")
+        for db in sorted(db_nodes):
+            w(f'    {dbid_of[db]}(["DB: {db}"])\n')
+        w("  end\n")
+    for en in sorted(entries):
+        w(f'  {en.replace(".","_")}(["{en}"]):::entry\n')
+    # label es Optional[str]: con None y str en la misma clave, sorted() sobre la tupla fallaría
+    # todas las aristas en una comprensión (una f-string por arista, sin ramas por línea)
+    label_edges = args.label_edges
+    parts.extend([
+        f"  {node_id[c]} {'-->' if mod_of[c] == m else '-.->'} {f'|{l}| ' if label_edges and l else ''}{m}_{fn}\n"
+        for c, m, fn, l in sorted(edges, key=_edge_key)
+    ])
+    if args.include_db:
+        for caller, db, op in sorted(db_edges, key=_db_edge_key):
+            lbl = f"|{op}|" if (args.label_edges and op) else ""
+            w(f"  {node_id[caller]} -.-> {lbl} {dbid_of[db]}\n")
+    w("classDef entry stroke-width:2px,stroke-dasharray:4 2;\n```\n")
+    out.write_bytes("".join(parts).encode("utf-8"))
     print(f"OK ➜ {out}")
 
 if __name__ == "__main__":
@@ -30,10 +30,17 @@ from __future__ import annotations
 import argparse
 import ast
 import dataclasses
+import functools
+import hashlib
+import mmap
 import os
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from datetime import datetime
+from string import Template
 
 # -------------------------
 # Modelos de datos
@@ -67,6 +74,27 @@ class FileInfo:
 # Descubrimiento de archivos
 # -------------------------
 
+# Directorios que nunca se recorren (mismos que los excludes por defecto de gather_files)
+_SKIP_DIRS = {
+    ".git", ".venv", "venv", "env", "__pycache__", ".mypy_cache", ".pytest_cache",
+    "node_modules", ".idea", ".vscode", "build", "dist", "site-packages", ".cache",
+}
+
+
+def _scan_py(root: str, recurse: bool) -> Iterable[str]:
+    """Rutas .py bajo root vía os.scandir (sin crear un Path por entrada), en orden alfabético."""
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    for e in entries:
+        if e.is_file() and e.name.endswith(".py"):
+            yield e.path
+        elif recurse and e.is_dir(follow_symlinks=False) and e.name not in _SKIP_DIRS:
+            yield from _scan_py(e.path, recurse)
+
+
 def gather_files(paths: Iterable[str], files: Iterable[str], recurse: bool, *,
                  project_root: Path,
                  include_globs: Optional[List[str]] = None,
@@ -100,48 +128,57 @@ def gather_files(paths: Iterable[str], files: Iterable[str], recurse: bool, *,
         return any(rel.match(g) or Path(s).match(g) for g in include_globs)
 
     found: List[Path] = []
+    seen: set = set()
+
+    def add(p: Path) -> None:
+        rp = str(p)
+        if rp not in seen and not is_excluded(p) and is_included(p):
+            seen.add(rp)
+            found.append(p)
 
     # Archivos explícitos
     for f in files:
         p = (project_root / f).resolve()
-        if p.is_file() and p.suffix == ".py" and not is_excluded(p) and is_included(p):
-            found.append(p)
+        if p.is_file() and p.suffix == ".py":
+            add(p)
 
     # Rutas/directorios
     for p_str in paths:
         p = (project_root / p_str).resolve()
         if p.is_file() and p.suffix == ".py":
-            if not is_excluded(p) and is_included(p):
-                found.append(p)
+            add(p)
         elif p.is_dir():
-            glob_pat = "**/*.py" if recurse else "*.py"
-            for candidate in sorted(p.glob(glob_pat)):
-                if candidate.is_file() and candidate.suffix == ".py":
-                    if not is_excluded(candidate) and is_included(candidate):
-                        found.append(candidate)
-
-    # Normalizar + únicos
-    uniq = []
-    seen = set()
-    for p in found:
-        rp = str(p.resolve())
-        if rp not in seen:
-            seen.add(rp)
-            uniq.append(p)
-    return uniq
+            for candidate in _scan_py(str(p), recurse):
+                add(Path(candidate))
+
+    return found
 
 
 # -------------------------
 # Parser AST
 # -------------------------
 
+MMAP_MIN_BYTES = 4096
+
+
+def _parse_source(path: Path) -> ast.Module:
+    """ast.parse directo sobre los bytes (mmap si el archivo es grande): sin copia a str."""
+    try:
+        if path.stat().st_size < MMAP_MIN_BYTES:
+            return ast.parse(path.read_bytes(), filename=str(path))
+        with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return ast.parse(mm, filename=str(path))
+    except (SyntaxError, ValueError):
+        # p.ej. bytes no UTF-8: mismo criterio de antes (se ignoran)
+        return ast.parse(path.read_text(encoding="utf-8", errors="ignore"), filename=str(path))
+
+
 def parse_python_file(path: Path, project_root: Path) -> FileInfo:
     rel_path = str(path.relative_to(project_root))
     module = path.stem
-    text = path.read_text(encoding="utf-8", errors="ignore")
     try:
-        tree = ast.parse(text)
-    except SyntaxError as e:
+        tree = _parse_source(path)
+    except (SyntaxError, ValueError):
         # Archivo inválido: devolvemos mínimos
         return FileInfo(
             path=path,
@@ -159,6 +196,31 @@ def parse_python_file(path: Path, project_root: Path) -> FileInfo:
     functions: List[FunctionInfo] = []
     classes: List[ClassInfo] = []
 
+    # Definiciones de primer nivel: basta con tree.body (sin recorrer todo el árbol)
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            functions.append(FunctionInfo(
+                name=node.name,
+                lineno=node.lineno,
+                doc=ast.get_docstring(node),
+            ))
+        elif isinstance(node, ast.ClassDef):
+            cls = ClassInfo(
+                name=node.name,
+                lineno=node.lineno,
+                doc=ast.get_docstring(node),
+            )
+            # métodos
+            for b in node.body:
+                if isinstance(b, ast.FunctionDef):
+                    cls.methods.append(FunctionInfo(
+                        name=b.name,
+                        lineno=b.lineno,
+                        doc=ast.get_docstring(b),
+                    ))
+            classes.append(cls)
+
+    # Imports en cualquier nivel (también los locales dentro de funciones)
     for node in ast.walk(tree):
         if isinstance(node, ast.Import):
             for n in node.names:
@@ -167,47 +229,68 @@ def parse_python_file(path: Path, project_root: Path) -> FileInfo:
             mod = node.module or ""
             names = ", ".join(n.name for n in node.names)
             imports.append(f"from {mod} import {names}")
-        elif isinstance(node, ast.FunctionDef):
-            # Solo de primer nivel
-            if isinstance(getattr(node, 'parent', None), ast.Module):
-                functions.append(FunctionInfo(
-                    name=node.name,
-                    lineno=node.lineno,
-                    doc=ast.get_docstring(node),
-                ))
-        elif isinstance(node, ast.ClassDef):
-            if isinstance(getattr(node, 'parent', None), ast.Module):
-                cls = ClassInfo(
-                    name=node.name,
-                    lineno=node.lineno,
-                    doc=ast.get_docstring(node),
-                )
-                # métodos
-                for b in node.body:
-                    if isinstance(b, ast.FunctionDef):
-                        cls.methods.append(FunctionInfo(
-                            name=b.name,
-                            lineno=b.lineno,
-                            doc=ast.get_docstring(b),
-                        ))
-                classes.append(cls)
-
-    # Añadir referencia al padre para distinguir nivel (pequeño truco)
-    for parent in ast.walk(tree):
-        for child in ast.iter_child_nodes(parent):
-            setattr(child, 'parent', parent)
 
     return FileInfo(
         path=path,
         rel_path=rel_path,
         module=module,
         doc=mod_doc,
-        imports=sorted(set(imports)),
+        imports=list(dict.fromkeys(imports)),  # sin duplicados, en orden de aparición
         functions=sorted(functions, key=lambda f: f.lineno),
         classes=sorted(classes, key=lambda c: c.lineno),
     )
 
 
+CACHE_DIR = Path(".cache") / "generate_readmes"
+CACHE_VERSION = 2  # subir si cambia lo que guarda FileInfo (invalida el caché viejo)
+
+
+def _cache_key(path: Path, project_root: Path) -> str:
+    # la raíz entra en la clave: FileInfo.rel_path depende de ella
+    st = path.stat()
+    return hashlib.blake2b(f"{CACHE_VERSION}:{project_root}:{path}:{st.st_mtime_ns}:{st.st_size}".encode(),
+                           digest_size=16).hexdigest()
+
+
+def parse_files(files: List[Path], project_root: Path, jobs: Optional[int] = None,
+                cache_dir: Optional[Path] = None) -> List[FileInfo]:
+    """Parsea en paralelo (procesos: ast es CPU puro); con pocos archivos o jobs=1, secuencial.
+
+    Con cache_dir, cada FileInfo se guarda en <cache_dir>/<hash(root, path, mtime, size)>.pkl:
+    los archivos sin cambios no se vuelven a parsear.
+    """
+    results: List[Optional[FileInfo]] = [None] * len(files)
+    keys: List[Optional[str]] = [None] * len(files)
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for i, p in enumerate(files):
+            keys[i] = _cache_key(p, project_root)
+            try:
+                with open(cache_dir / f"{keys[i]}.pkl", "rb") as fh:
+                    results[i] = pickle.load(fh)
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                pass  # no está o quedó ilegible: se re-parsea
+
+    todo = [i for i, r in enumerate(results) if r is None]
+    pending = [files[i] for i in todo]
+    if len(pending) < 4 or jobs == 1:
+        fresh = [parse_python_file(p, project_root) for p in pending]
+    else:
+        parse = functools.partial(parse_python_file, project_root=project_root)
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            fresh = list(ex.map(parse, pending, chunksize=8))
+
+    for i, info in zip(todo, fresh):
+        results[i] = info
+        if cache_dir is not None:
+            # tmp + os.replace: un proceso cortado o concurrente nunca deja un .pkl a medias
+            cpath = cache_dir / f"{keys[i]}.pkl"
+            tmp = cpath.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_bytes(pickle.dumps(info, protocol=pickle.HIGHEST_PROTOCOL))
+            os.replace(tmp, cpath)
+    return results  # type: ignore[return-value]
+
+
 # -------------------------
 # Plantillas (Jinja2 si disponible; fallback string)
 # -------------------------
@@ -222,6 +305,29 @@ DEFAULT_ROOT_TMPL = """# {{ project_title }}\n\n{{ project_desc }}\n\n- Generado
 DEFAULT_FILE_TMPL = """# {{ f.module }}\n\nRuta: `{{ f.rel_path }}`\n\n{% if f.doc %}> {{ f.doc | replace('\n', '\n> ') }}\n{% endif %}\n\n## Imports\n{% if f.imports %}{% for i in f.imports %}- `{{ i }}`\n{% endfor %}{% else %}_No se detectaron imports._\n{% endif %}\n\n## Funciones\n{% if f.functions %}{% for fn in f.functions %}- `{{ fn.name }}` (línea {{ fn.lineno }}){% if fn.doc %}: {{ fn.doc.split('\n')[0] }}{% endif %}\n{% endfor %}{% else %}_No se detectaron funciones de nivel módulo._\n{% endif %}\n\n## Clases\n{% if f.classes %}{% for c in f.classes %}- **{{ c.name }}** (línea {{ c.lineno }}){% if c.doc %}: {{ c.doc.split('\n')[0] }}{% endif %}\n  {% if c.methods %}  - Métodos:\n    {% for m in c.methods %}  - `{{ m.name }}` ({{ m.lineno }}){% if m.doc %}: {{ m.doc.split('\n')[0] }}{% endif %}\n    {% endfor %}{% endif %}\n{% endfor %}{% else %}_No se detectaron clases._\n{% endif %}\n\n## Diagramas\n{% if drawio %}- draw.io: `{{ drawio }}`{% else %}_No se encontró .drawio_\n{% endif %}\n{% if mermaid %}- Mermaid: `{{ mermaid }}`{% else %}_No se encontró .md (Mermaid)_\n{% endif %}\n\n## SQL relacionado\n{% if sql_anchor %}- Ver `{{ sql_file }}` → sección **{{ anchor_label }}**{% else %}_No se encontró referencia en sql_insights.md_\n{% endif %}\n"""
 
 
+_ROOT_TMPL_RE = re.compile(
+    r"(?P<loop>\{% for f in files %\}.*?\{% endfor %\})"
+    r"|\{\{\s*(?P<var>\w+)(?P<length>\|length)?\s*\}\}",
+    re.S,
+)
+
+
+# Piezas del fallback de render_file (se compilan una sola vez)
+_F_HEAD = Template("# $module\nRuta: `$rel_path`\n\n")
+_F_DOC = Template("> $doc\n\n")
+_F_IMPORT = Template("- `$name`\n")
+_F_FUNC = Template("- `$name` (línea $lineno)$doc\n")
+_F_CLASS = Template("- **$name** (línea $lineno)$doc\n")
+_F_METHOD = Template("  - `$name` ($lineno)$doc\n")
+_F_DRAWIO = Template("- draw.io: `$path`\n")
+_F_MERMAID = Template("- Mermaid: `$path`\n")
+_F_SQL = Template("- Ver `$sql_file` → sección **$label**\n")
+
+
+def _first_line(doc: Optional[str]) -> str:
+    return ": " + doc.split("\n")[0] if doc else ""
+
+
 def load_env(template_root: Optional[Path]):
     if Environment and template_root and template_root.exists():
         return Environment(
@@ -234,75 +340,64 @@ def load_env(template_root: Optional[Path]):
 def render_root(env, context, template_name: Optional[str]) -> str:
     if env and template_name:
         return env.get_template(template_name).render(**context)
-    # Fallback
-    from string import Template
-    # Usamos Jinja-like con reemplazos mínimos vía Template donde aplica
-    return DEFAULT_ROOT_TMPL.replace("{{ project_title }}", context["project_title"]) \
-        .replace("{{ project_desc }}", context["project_desc"]) \
-        .replace("{{ now }}", context["now"]) \
-        .replace("{{ docs_out }}", context["docs_out"]) \
-        .replace("{{ files|length }}", str(len(context["files"]))) \
-        .replace("{% for f in files %}", "").replace("{% endfor %}", "") \
-        + "".join([f"- [{f.module}]({context['docs_out']}/{f.module}.md) — {f.rel_path}\n" for f in context["files"]])
+    # Fallback: una sola pasada de regex sobre la plantilla ({% for %} + {{ var }} / {{ var|length }})
+    items = "".join(f"- [{f.module}]({context['docs_out']}/{f.module}.md) — {f.rel_path}\n"
+                    for f in context["files"])
+
+    def _sub(m: re.Match) -> str:
+        if m.group("loop") is not None:
+            return items
+        val = context[m.group("var")]
+        return str(len(val)) if m.group("length") else str(val)
+
+    return _ROOT_TMPL_RE.sub(_sub, DEFAULT_ROOT_TMPL)
 
 
 def render_file(env, context, template_name: Optional[str]) -> str:
     if env and template_name:
         return env.get_template(template_name).render(**context)
-    # Fallback: render muy simple por formato
+    # Fallback: piezas string.Template armadas una vez al importar el módulo
     f = context["f"]
-    lines = [f"# {f.module}\n", f"Ruta: `{f.rel_path}`\n\n"]
+    parts = [_F_HEAD.substitute(module=f.module, rel_path=f.rel_path)]
     if f.doc:
-        lines.append("> " + f.doc.replace("\n", "\n> ") + "\n\n")
-    # Imports
-    lines.append("## Imports\n")
+        parts.append(_F_DOC.substitute(doc=f.doc.replace("\n", "\n> ")))
+    parts.append("## Imports\n")
     if f.imports:
-        for i in f.imports:
-            lines.append(f"- `{i}`\n")
+        parts.extend(_F_IMPORT.substitute(name=i) for i in f.imports)
     else:
-        lines.append("_No se detectaron imports._\n")
-    lines.append("\n## Funciones\n")
+        parts.append("_No se detectaron imports._\n")
+    parts.append("\n## Funciones\n")
     if f.functions:
-        for fn in f.functions:
-            head = f"- `{fn.name}` (línea {fn.lineno})"
-            if fn.doc:
-                head += f": {fn.doc.split('\n')[0]}"
-            lines.append(head + "\n")
+        parts.extend(_F_FUNC.substitute(name=fn.name, lineno=fn.lineno, doc=_first_line(fn.doc))
+                     for fn in f.functions)
     else:
-        lines.append("_No se detectaron funciones de nivel módulo._\n")
-    lines.append("\n## Clases\n")
+        parts.append("_No se detectaron funciones de nivel módulo._\n")
+    parts.append("\n## Clases\n")
     if f.classes:
         for c in f.classes:
-            head = f"- **{c.name}** (línea {c.lineno})"
-            if c.doc:
-                head += f": {c.doc.split('\n')[0]}"
-            lines.append(head + "\n")
+            parts.append(_F_CLASS.substitute(name=c.name, lineno=c.lineno, doc=_first_line(c.doc)))
             if c.methods:
-                lines.append("  - Métodos:\n")
-                for m in c.methods:
-                    mh = f"  - `{m.name}` ({m.lineno})"
-                    if m.doc:
-                        mh += f": {m.doc.split('\n')[0]}"
-                    lines.append(mh + "\n")
+                parts.append("  - Métodos:\n")
+                parts.extend(_F_METHOD.substitute(name=m.name, lineno=m.lineno, doc=_first_line(m.doc))
+                             for m in c.methods)
     else:
-        lines.append("_No se detectaron clases._\n")
+        parts.append("_No se detectaron clases._\n")
 
     # Diagramas
-    lines.append("\n## Diagramas\n")
+    parts.append("\n## Diagramas\n")
     drawio = context.get("drawio")
     mermaid = context.get("mermaid")
-    lines.append(f"- draw.io: `{drawio}`\n" if drawio else "_No se encontró .drawio_\n")
-    lines.append(f"- Mermaid: `{mermaid}`\n" if mermaid else "_No se encontró .md (Mermaid)_\n")
+    parts.append(_F_DRAWIO.substitute(path=drawio) if drawio else "_No se encontró .drawio_\n")
+    parts.append(_F_MERMAID.substitute(path=mermaid) if mermaid else "_No se encontró .md (Mermaid)_\n")
 
     # SQL
-    lines.append("\n## SQL relacionado\n")
-    anchor = context.get("sql_anchor")
-    if anchor:
-        lines.append(f"- Ver `{context['sql_file']}` → sección **{context['anchor_label']}**\n")
+    parts.append("\n## SQL relacionado\n")
+    if context.get("sql_anchor"):
+        parts.append(_F_SQL.substitute(sql_file=context["sql_file"], label=context["anchor_label"]))
     else:
-        lines.append("_No se encontró referencia en sql_insights.md_\n")
+        parts.append("_No se encontró referencia en sql_insights.md_\n")
 
-    return "".join(lines)
+    return "".join(parts)
 
 
 # -------------------------
@@ -318,24 +413,41 @@ def guess_diagram_paths(docs_out: Path, module: str) -> Tuple[Optional[str], Opt
     )
 
 
-def find_sql_anchor(sql_file: Path, module: str) -> Tuple[Optional[str], Optional[str]]:
-    """Devuelve (anchor, label) si encuentra sección para el archivo en sql_insights.md"""
-    if not sql_file.exists():
-        return None, None
+def _heading_modules(line: str) -> List[str]:
+    """Todo 'M' tal que la línea empieza con 'M.py' (lo que calzaría text.find(f"## {M}.py"))."""
+    out, k = [], line.find(".py")
+    while k != -1:
+        out.append(line[:k])
+        k = line.find(".py", k + 1)
+    return out
+
+
+def index_sql_anchors(sql_file: Path) -> Dict[str, Tuple[str, str]]:
+    """Lee sql_insights.md una vez y devuelve {módulo: (anchor, label)}.
+
+    Mismo criterio que buscar "### nombre.py" y luego "## nombre.py" en el texto (gana "###"),
+    con el anchor de siempre: el encabezado en minúsculas, espacios -> '-' y sin puntos.
+    """
     try:
         text = sql_file.read_text(encoding="utf-8", errors="ignore")
-    except Exception:
-        return None, None
-    # Heurística: buscar encabezados como "## nombre.py" o "### nombre.py"
-    for prefix in ("### ", "## "):
-        tag = f"{prefix}{module}.py"
-        idx = text.find(tag)
-        if idx != -1:
-            # Construimos un anchor compatible con GitHub (simplificado)
-            anchor = tag.lower().replace(" ", "-").replace(".", "")
-            label = f"{module}.py"
-            return anchor, label
-    return None, None
+    except OSError:
+        return {}
+    h2: Set[str] = set()
+    h3: Set[str] = set()
+    pos = text.find("## ")
+    while pos != -1:
+        end = text.find("\n", pos)
+        mods = _heading_modules(text[pos + 3:end if end != -1 else len(text)])
+        h2.update(mods)
+        if pos and text[pos - 1] == "#":
+            h3.update(mods)
+        pos = text.find("## ", pos + 1)
+    index: Dict[str, Tuple[str, str]] = {}
+    for prefix, mods in (("## ", h2), ("### ", h3)):  # "###" pisa a "##"
+        for module in mods:
+            tag = f"{prefix}{module}.py"
+            index[module] = (tag.lower().replace(" ", "-").replace(".", ""), f"{module}.py")
+    return index
 
 
 # -------------------------
@@ -366,13 +478,15 @@ def render_project(
         "files": files,
     }
     root_md = render_root(env, context_root, root_template)
-    outfile_root.write_text(root_md, encoding="utf-8")
+    # (ruta, bytes): se escriben al final en hilos, así el I/O se solapa entre archivos
+    outputs: List[Tuple[Path, bytes]] = [(outfile_root, root_md.encode("utf-8"))]
 
     # Docs por archivo
     sql_file = docs_out / "sql_insights.md"
+    sql_index = index_sql_anchors(sql_file)
     for f in files:
         drawio, mermaid = guess_diagram_paths(docs_out, f.module)
-        anchor, label = find_sql_anchor(sql_file, f.module)
+        anchor, label = sql_index.get(f.module, (None, None))
         context_file = {
             "f": f,
             "drawio": drawio,
@@ -382,7 +496,10 @@ def render_project(
             "anchor_label": label,
         }
         text = render_file(env, context_file, file_template)
-        (docs_out / f"{f.module}.md").write_text(text, encoding="utf-8")
+        outputs.append((docs_out / f"{f.module}.md", text.encode("utf-8")))
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        list(ex.map(lambda pb: pb[0].write_bytes(pb[1]), outputs))
 
 
 # -------------------------
@@ -405,6 +522,8 @@ def build_argparser() -> argparse.ArgumentParser:
     # NUEVO: filtros
     p.add_argument("--include", nargs="*", default=[], help="Patrones glob para *incluir* (relativos al proyecto)")
     p.add_argument("--exclude", nargs="*", default=[], help="Patrones glob adicionales para *excluir*")
+    p.add_argument("--no-cache", action="store_true", help=f"No usar el caché de parseo ({CACHE_DIR})")
+    p.add_argument("--jobs", type=int, default=None, help="Procesos para parsear (1 = secuencial; por defecto nº de CPUs)")
     return p
 
 
@@ -430,7 +549,8 @@ def main(argv: Optional[List[str]] = None) -> int:
         print("No se encontraron archivos .py a analizar.")
         return 1
 
-    parsed: List[FileInfo] = [parse_python_file(p, project_root) for p in files]
+    cache_dir = None if args.no_cache else project_root / CACHE_DIR
+    parsed: List[FileInfo] = parse_files(files, project_root, args.jobs, cache_dir)
 
     template_root = Path(args.template_root) if args.template_root else None
 